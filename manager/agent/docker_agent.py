@@ -1,4 +1,4 @@
-import os, sys, platform, socket, shutil, hashlib, uuid, docker
+import os, sys, platform, docker
 import docker.errors
 import docker.models
 import docker.models.containers
@@ -7,19 +7,17 @@ import pandas as pd
 import plotly.graph_objects as go
 import dateutil.parser
 import webbrowser
-import subprocess
-import platform
 import requests
-import atexit
 
-from datetime import datetime
-from typing import Dict, Optional
+from typing import Optional
 from loguru import logger
 from dotenv import load_dotenv
 from streamlit_option_menu import option_menu
 
 # project
 from resource_manager import PortManager
+from proxy import proxy_urls
+from provisioning import STEPS, ProvisioningQueue, get_contianer_name, get_machine_ip, is_proxy_mode
 
 class DockerContainerManager:
     def __init__(self):
@@ -30,57 +28,6 @@ class DockerContainerManager:
             logger.error(f"Error connecting to Docker daemon: {e}")
             sys.exit(1)
 
-    def create_container(
-        self,
-        image_name: str,
-        container_name: str = None,
-        ports: Dict[str, str] = None,
-        volumes: Dict[str, Dict[str, str]] = None,
-        environment: Dict[str, str] = None,
-        command: str = None,
-        detach: bool = True,
-        cpu_count: float = None,
-        cpu_percent: int = None,
-        memory_limit: str = None,
-        memory_swap: str = None,
-        memory_reservation: str = None,
-        host_name: str = "cx-qvp"
-    ):
-        try:
-            # Pull the image if it doesn't exist
-            try:
-                self.client.images.get(image_name)
-            except docker.errors.ImageNotFound:
-                logger.warning(f"Pulling image {image_name}...")
-                try:
-                    image = self.client.images.pull(image_name)
-                except docker.errors.APIError as e:
-                    logger.error("Failed pulling image")
-                    return None, f"Failed pulling image {image_name} Exception : {e}"
-
-            # Create and start the container
-            container = self.client.containers.run(
-                image=image_name,
-                name=container_name,
-                ports=ports,
-                volumes=volumes,
-                environment=environment,
-                command=command,
-                detach=detach,
-                cpu_count=cpu_count,
-                cpu_percent=cpu_percent,
-                mem_limit=memory_limit,
-                memswap_limit=memory_swap,
-                hostname=host_name,
-                privileged=True
-            )
-            logger.success(f"Container created successfully: {container.name}")
-            return container, "Sucess"
-
-        except docker.errors.APIError as e:
-            logger.error(f"Error creating container: {e}")
-            return None, f"Error creating container: {e}"
-
     def list_container(self, name: str) -> Optional[docker.models.containers.Container]:
         try:
             container = self.client.containers.get(name)
@@ -244,8 +191,9 @@ def display_container_actions(container, user):
         if st.button("🗑️ Remove"):
             try:
                 container.remove(force=True)
-                port_manager = PortManager()
-                new_ports = port_manager.deallocate_ports(user)
+                if not is_proxy_mode():
+                    port_manager = PortManager()
+                    new_ports = port_manager.deallocate_ports(user)
                 st.success("Container removed successfully")
                 st.rerun()
             except Exception as e:
@@ -256,35 +204,39 @@ def blue_header(text):
 
 def display_service_actions(container, user, page):
         
-    port_manager = PortManager()
-    port_range = port_manager.get_allocated_ports(user)
-
-    ports = {}
-    ports["code_port_host"] = port_range["start_port"]
-    ports["ssh_port_host"] = port_range["start_port"] + 1
-    ports["spice_port_host"] = port_range["start_port"] + 2
-    ports["fm_ui_port_host"] = port_range["start_port"] + 3
-    ports["fm_port_host"] = port_range["start_port"] + 4
-
-    container_ip = container.attrs["NetworkSettings"].get("IPAddress") or next(
-        (
-            net.get("IPAddress", "N/A")
-            for net in container.attrs["NetworkSettings"]["Networks"].values()
-        ),
-        "N/A",
-    )
-
     container_ip, publicip = get_machine_ip()
+    if is_proxy_mode():
+        # All services go through the agent's reverse proxy, see proxy.py
+        links = proxy_urls(user, container_ip)
+        ports = {"proxy_port_host": int(os.getenv("PROXY_PORT", 8600))}
+    else:
+        port_manager = PortManager()
+        port_range = port_manager.get_allocated_ports(user)
+
+        ports = {}
+        ports["code_port_host"] = port_range["start_port"]
+        ports["ssh_port_host"] = port_range["start_port"] + 1
+        ports["spice_port_host"] = port_range["start_port"] + 2
+        ports["fm_ui_port_host"] = port_range["start_port"] + 3
+        ports["fm_port_host"] = port_range["start_port"] + 4
+
+        links = {
+            "code": f"http://{container_ip}:{ports['code_port_host']}",
+            "ssh": f"ssh -p {ports['ssh_port_host']} root@{container_ip}",
+            "spice": f"remote-viewer spice://{container_ip}:{ports['spice_port_host']}",
+            "fm-ui": f"http://{container_ip}:{ports['fm_ui_port_host']}",
+        }
+
     if page == None:
         st.write('No Conainers found...')
 
     elif page == 'VS Code':
-        url = f"http://{container_ip}:{ports['code_port_host']}"
+        url = links["code"]
         blue_header(url)
         webbrowser.open(url)
 
     elif page == 'SSH':
-        cmd = f"ssh -p {ports['ssh_port_host']} root@{container_ip}"
+        cmd = links["ssh"]
         st.write("Run below command in putty or click below to download script")
         col0, col1 = st.columns(2)
         with col0:
@@ -296,7 +248,7 @@ def display_service_actions(container, user, page):
                 st.download_button(label="📥 SSH", data=cmd, file_name="ssh.sh", mime="application/bash")
 
     elif page == 'RDP':
-        cmd = f"remote-viewer spice://{container_ip}:{ports['spice_port_host']}"
+        cmd = links["spice"]
         st.write("Run below command in SPICE viewer or click below to download script")
         col0, col1 = st.columns(2)
         with col0:
@@ -308,7 +260,7 @@ def display_service_actions(container, user, page):
                 st.download_button(label="📥 RDP", data=cmd, file_name="rdp.sh", mime="application/bash")
     
     elif page == 'FM-UI':
-        url = f"http://{container_ip}:{ports['fm_ui_port_host']}"
+        url = links["fm-ui"]
         blue_header(url)
         webbrowser.open(url)
 
@@ -334,16 +286,6 @@ def add_download_tools(tool, label, path, mime):
         logger.warning(f"Failed setting up download {tool}")
 
     
-def generate_user_hash(username: str) -> str:
-    import hashlib
-
-    # Create SHA-256 hash of username
-    hash_obj = hashlib.sha256(username.encode())
-
-    # Get first 16 characters of hexadecimal hash
-    return hash_obj.hexdigest()[:16]
-
-
 def render_page(user):
     manager = DockerContainerManager()
 
@@ -371,9 +313,18 @@ def render_page(user):
     container = manager.list_container(name)
 
     if not container:
+        # Provisioning runs as a job in the stats.py worker, it survives reruns and closed tabs
+        queue = ProvisioningQueue()
+        job = queue.latest_job(user)
+        if job and job["state"] in ("queued", "running"):
+            display_provisioning(queue, job["id"])
+            return
+        if job and job["state"] == "failed":
+            st.error(f"Last provisioning failed in step {job['step']}: {job['error']}", icon="🚨")
         st.info("No containers found")
         if st.button("▶️ Create"):
-            create_start_container(manager, user)
+            queue.submit(user)
+            st.rerun()
         return
 
     if page == 'Home':
@@ -401,241 +352,17 @@ def render_page(user):
 
     display_service_actions(container, user, page)
 
-def get_contianer_name(user):
-    name = f"code-server-{user}-{generate_user_hash(user)}"
-    return name
-
-def get_machine_ip():
-    """
-    Get both local and public IP addresses of the machine.
-    Returns a tuple of (local_ip, public_ip)
-    """
-    # Get local IP
-    try:
-        # Create a socket object
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        # Doesn't actually connect but helps get local IP
-        s.connect(('8.8.8.8', 80))
-        local_ip = s.getsockname()[0]
-        s.close()
-    except Exception as e:
-        local_ip = "Could not determine local IP: " + str(e)
-
-    # Get public IP
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        public_ip = s.getsockname()[0]
-        s.close()
-    except Exception as e:
-        public_ip = "Could not determine public IP: " + str(e)
-
-    # return "127.0.0.1", "127.0.0.1"
-    return local_ip, public_ip
-
-def is_valid_dir(dir):
-    if not os.path.exists(dir):
-        return False, "Destination directory does not exist."
-    if not os.path.isdir(dir):
-        return False, "Destination path is not a directory."
-    if not os.listdir(dir):
-        return False, "Destination directory is empty."
-    return True, "Destination directory is valid."
-
-def is_valid_sign(dir):
-    signature_file = f"{dir}" + "/signature.txt"
-    if not os.path.exists(signature_file):
-        return False, "Signature file does not exist."
-    with open(signature_file, 'r') as file:
-        content = file.read()
-        if "Timestamp:" not in content or "Unique Hash:" not in content:
-            return False, "Signature file is missing required content."
-    return True, "Signature file is valid."
-
-def copy_dir_with_progress(src, dst, progress_bar):
-    items = os.listdir(src)
-    total_items = len(items)
-    copied_items = 0
-
-    logger.info(total_items)
-    for item in items:
-        progress = int ((copied_items/total_items) * 100)
-        progress_bar.progress(progress, text=f"Copying {item} ...")
-        src_path = os.path.join(src, item)
-        dst_path = os.path.join(dst, item)
-
-        if os.path.isfile(src_path):
-            logger.info(f"File copy {src_path}")
-            shutil.copy2(src_path, dst_path)
-        elif os.path.isdir(src_path):
-            logger.info(f"Dir copy {src_path}")
-            shutil.copytree(src_path, dst_path)
-        copied_items += 1
-        logger.error(progress)
-
-def setup_workdir(user, dir_template, dir_deploy):
-    valid_dir, dir_error = is_valid_dir(dir_deploy)
-    valid_sign, sign_error = is_valid_sign(dir_deploy)
-
-    if valid_dir and valid_sign:
-        logger.success("Valid workdir exists")
-        return True
-
-    logger.warning(f"{dir_error}, {sign_error}")
-    progress_bar = st.progress(0)
-
-    try:
-        # shutil.copytree(dir_template, f"{dir_deploy}", progress_bar)
-        copy_dir_with_progress(dir_template, f"{dir_deploy}", progress_bar)
-
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-        # Generate a unique hash (using UUID)
-        unique_hash = hashlib.sha256(str(uuid.uuid4()).encode()).hexdigest()
-
-        progress_bar.progress(90, text="Setting up signature...")
-        # Create a signature file in the destination directory
-        signature_file_path = os.path.join(dir_deploy, 'signature.txt')
-        with open(signature_file_path, 'w') as signature_file:
-            signature_file.write(f"Timestamp: {timestamp}\n")
-            signature_file.write(f"Unique Hash: {unique_hash}\n")
-
-    except Exception as e:
-        logger.error(f"Failed setting up workdir for user {user} : Exception {e}")
-        return False
-
-    progress_bar.progress(100, text="Almost there !! Setting up your container..")
-    return True
-
-def create_overlay(base_image_path, overlay_image_path):
-    try:
-        command = f"qemu-img create -f qcow2 -b {base_image_path} -F qcow2 {overlay_image_path}"
-        subprocess.check_call(command, shell=True)
-        return True
-
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Failed to create overlay image: {e}")
-        return False
-
-def create_start_container(manager, user):
-    # Load environment variables from .env file
-    load_dotenv("../.env", override=True)
-    env = {}
-    env["PUID"] = os.geteuid()
-    env["PGID"] = os.getegid()
-    env["TZ"] = "Etc/UTC"
-    env["DEFAULT_WORKSPACE"] = os.getenv("DEFAULT_WORKSPACE", "/config/workspace")
-    env["SUDO_PASSWORD"] = os.getenv("SUDO_PASSWORD", "abc")
-
-    docker_image_name = os.getenv("DOCKER_IMAGE", "cxl.io/dev/code-server")
-    docker_image_tag = os.getenv("DOCKER_TAG", "latest")
-
-    dir_template = os.getenv("WORKDIR_TEMPLATE", "/opt/cxl/")
-    dir_deploy = os.getenv("WORKDIR_DEPLOY", "/home/vms/") + f"{user}-{generate_user_hash(user)}" 
-
-    if setup_workdir(user, dir_template, dir_deploy) == False:
-        error_msg(f"Failed setting up workdir for {user}, please contact admin")
-        return
-
-    # create overlay for guest os provided
-    guest_os_list = [item.strip() for item in os.getenv("GUEST_OS_LIST").split(",")]
-    for guest_os in guest_os_list:
-        dst_path = f"{dir_deploy}/guestos/{os.path.basename(os.path.dirname(guest_os))}"
-        os.makedirs(dst_path, exist_ok=True)
-        file_name = os.path.basename(guest_os)
-        name, ext = os.path.splitext(file_name)
-        new_file_name = f"{dst_path}/{name}_overlay{ext}"
-        logger.info(f"Creating Overlay : {guest_os}, {new_file_name}")
-        if create_overlay(guest_os, new_file_name) == False:
-            error_msg(f"Failed creating overlay for {user}, please contact admin")
-            return
-
-    # TODO revamp this section
-    container_name = get_contianer_name(user)
-    guest_os_path_host = os.path.join(dir_deploy, "guestos")
-    config_path_host = os.path.join(dir_deploy, "code/config")
-    qvp_bin_path_host = os.path.join(dir_deploy, "qvp")
-    tools_path_host = os.path.join(dir_deploy, "tools")
-    arm_path_host = os.path.join(dir_deploy, "tools/ARMCompiler6.16")
-
-    port_manager = PortManager()
-    new_ports = port_manager.allocate_ports(user)
-    start_port = int(new_ports["start_port"])
-
-    code_port_host = start_port
-    ssh_port_host = start_port + 1
-    spice_port_host = start_port + 2
-    fm_ui_port_host = start_port + 3
-    fm_port_host = start_port + 4
-
-    volumes = {}
-
-    volumes["/dev/kvm"] = {
-        "bind": "/dev/kvm",
-        "mode": "rw",
-    }
-
-    volumes["/opt/os/guestos_base"] = {
-        "bind": "/opt/os/guestos_base",
-        "mode": "ro",
-    }
-
-    volumes[guest_os_path_host] = {
-        "bind": os.getenv("GUEST_OS_MOUNT"),
-        "mode": "rw",
-    }
-    volumes[config_path_host] = {
-        "bind": os.getenv("CODE_CONFIG_MOUNT"),
-        "mode": "rw",
-    }
-
-    volumes[qvp_bin_path_host] = {
-        "bind": os.getenv("QVP_BINARY_MOUNT"),
-        "mode": "rw",
-    }
-
-    volumes[tools_path_host] = {
-        "bind": os.getenv("TOOLS_MOUNT"),
-        "mode": "ro",
-    }
-
-    volumes[arm_path_host] = {
-        "bind": "/usr/local/ARMCompiler6.16",
-        "mode": "ro",
-    }
-
-    volumes["/dev/kvm"] = {
-        "bind": "/dev/kvm",
-        "mode": "rw",
-    }
-
-    ports = {}
-    ports[os.getenv("CODE_PORT", 8443)] = code_port_host
-    ports[os.getenv("GUEST_OS_SSH_PORT", 22)] = ssh_port_host
-    ports[os.getenv("GUEST_OS_SPICE_PORT", 3001)] = spice_port_host
-    ports[os.getenv("OPENCXL_FM_PORT", 8000)] = fm_port_host
-    ports[os.getenv("OPENCXL_FM_UI_PORT", 3000)] = fm_ui_port_host
-
-    try:
-        container, error = manager.create_container(
-            image_name=f"{docker_image_name}:{docker_image_tag}",
-            container_name=container_name,
-            ports=ports,
-            volumes=volumes,
-            environment=env,
-            cpu_count=int(os.getenv("DOCKER_CPU", 2)),
-            cpu_percent=int(os.getenv("DOCKER_CPU_PERCENT", 100)),
-            memory_limit=os.getenv("DOCKER_MEM_LMT", "2g"),
-            memory_swap=os.getenv("DOCKER_MEM_SWAP", "3g"),
-            host_name = os.getenv("DOCKER_HOSTNAME", "cxl-qvp")
-        )
-        if container == None:
-            error_msg(f"Failed to start container: {str(error)}")
-            return
-
+@st.fragment(run_every=2)
+def display_provisioning(queue, job_id):
+    job = queue.job(job_id)
+    if job["state"] not in ("queued", "running"):
         st.rerun()
-    except Exception as e:
-        error_msg(f"Failed to start container: {str(e)}")
+
+    done = STEPS.index(job["step"]) if job["step"] in STEPS else 0
+    st.progress(min(1.0, (done + job["progress"]) / len(STEPS)), text=job["message"])
+    for step, seconds in job["steps"].items():
+        if seconds is not None:
+            st.write(f"✅ {step} ({seconds:.1f}s)")
 
 def is_valid_session(remote_server_url, user_id, session_token):
     payload = {
@@ -0,0 +1,184 @@
+import hashlib
+import hmac
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+# qcow2 creation options tuned for guest I/O on a copy-on-write overlay:
+# - cluster_size=128k with extended_l2=on: 4k subclusters, so a small guest write
+#   allocates 4k instead of copying a whole cluster up from the base image
+# - lazy_refcounts=on: no refcount update on every cluster allocation
+# - preallocation=metadata: L2 tables written up front, not while the guest runs
+# extended_l2 needs qemu-img >= 5.2. On an overlay (which has a backing file)
+# preallocation in turn needs extended_l2=on, so drop both together on older
+# versions, e.g. QCOW2_OPTIONS="cluster_size=128k,lazy_refcounts=on", or "".
+DEFAULT_QCOW2_OPTIONS = "cluster_size=128k,extended_l2=on,lazy_refcounts=on,preallocation=metadata"
+
+
+def qcow2_options():
+    return os.getenv("QCOW2_OPTIONS", DEFAULT_QCOW2_OPTIONS).strip()
+
+
+def overlay_mode():
+    """"lazy" creates overlays when a guest is first launched, needs OVERLAY_HOOK_SECRET"""
+    if os.getenv("GUEST_OVERLAYS", "eager") == "lazy":
+        if os.getenv("OVERLAY_HOOK_SECRET"):
+            return "lazy"
+        logger.warning("GUEST_OVERLAYS=lazy without OVERLAY_HOOK_SECRET, creating overlays eagerly")
+    return "eager"
+
+
+def guest_images():
+    """{guest: base image} from GUEST_OS_LIST, a guest is named after its image directory"""
+    images = [item.strip() for item in os.getenv("GUEST_OS_LIST", "").split(",") if item.strip()]
+    return {os.path.basename(os.path.dirname(image)): image for image in images}
+
+
+def overlay_token(user, secret=None):
+    """Token a user's container presents to the overlay hook, only valid for that user"""
+    secret = secret or os.getenv("OVERLAY_HOOK_SECRET", "")
+    return hmac.new(secret.encode(), user.encode(), hashlib.sha256).hexdigest()
+
+
+def valid_overlay_token(user, token):
+    return bool(os.getenv("OVERLAY_HOOK_SECRET")) and hmac.compare_digest(overlay_token(user), token or "")
+
+
+def overlay_path(guest_os, dir_deploy):
+    """`{dir_deploy}/guestos/{distro}/{name}_overlay.qcow2` for base image `guest_os`"""
+    dst_path = os.path.join(dir_deploy, "guestos", os.path.basename(os.path.dirname(guest_os)))
+    name, ext = os.path.splitext(os.path.basename(guest_os))
+    return os.path.join(dst_path, f"{name}_overlay{ext}")
+
+
+def create_overlay(base_image_path, overlay_image_path, options=None, timeout=120):
+    """Create a qcow2 overlay backed by `base_image_path`, returns the seconds it took"""
+    options = qcow2_options() if options is None else options
+    command = ["qemu-img", "create", "-f", "qcow2", "-b", base_image_path, "-F", "qcow2"]
+    if options:
+        command += ["-o", options]
+
+    # Created under a temporary name, so a timeout or a killed agent never leaves
+    # a truncated overlay at the final path (existing overlays are not recreated)
+    part = overlay_image_path + ".part"
+    command.append(part)
+
+    started = time.monotonic()
+    os.makedirs(os.path.dirname(overlay_image_path), exist_ok=True)
+    try:
+        subprocess.run(command, check=True, capture_output=True, text=True, timeout=timeout)
+        os.replace(part, overlay_image_path)
+    finally:
+        if os.path.exists(part):
+            os.remove(part)
+    return time.monotonic() - started
+
+
+def create_overlays(guest_os_list, dir_deploy, workers=None):
+    """
+    Create the overlays of all guest images concurrently.
+
+    Returns {overlay path: seconds}. Raises the first failure after all
+    creations finished, with qemu-img's error output logged.
+    """
+    jobs = {overlay_path(guest_os, dir_deploy): guest_os for guest_os in guest_os_list}
+    workers = workers or int(os.getenv("OVERLAY_WORKERS", len(jobs))) or 1
+    timings = {}
+    failure = None
+
+    with ThreadPoolExecutor(max(1, workers)) as executor:
+        futures = {executor.submit(create_overlay, base, overlay): overlay for overlay, base in jobs.items()}
+        for future, overlay in futures.items():
+            try:
+                timings[overlay] = future.result()
+                logger.info(f"Created overlay {overlay} of {jobs[overlay]} in {timings[overlay]:.2f}s")
+            except subprocess.CalledProcessError as e:
+                logger.error(f"Failed to create overlay image {overlay}: {e.stderr.strip() or e}")
+                failure = failure or e
+            except (subprocess.TimeoutExpired, OSError) as e:
+                logger.error(f"Failed to create overlay image {overlay}: {e}")
+                failure = failure or e
+    if failure is not None:
+        raise failure
+    return timings
+
+
+class OverlayIndex:
+    """Which guest overlays exist for which user, with their creation time"""
+
+    def __init__(self, db_path="guest_overlays.db"):
+        self.db_path = db_path
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS guest_overlays (
+                    user_id TEXT NOT NULL,
+                    guest TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    seconds REAL,
+                    PRIMARY KEY (user_id, guest)
+                )
+            """)
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def _lock(self, user, guest):
+        with self._locks_lock:
+            return self._locks.setdefault((user, guest), threading.Lock())
+
+    def record(self, user, guest, path, seconds=None):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO guest_overlays (user_id, guest, path, created_at, seconds) VALUES (?, ?, ?, ?, ?)",
+                (user, guest, path, time.time(), seconds),
+            )
+
+    def overlays(self, user):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT guest, path, created_at, seconds FROM guest_overlays WHERE user_id = ?", (user,)
+            ).fetchall()
+        return {guest: {"path": path, "created_at": created_at, "seconds": seconds} for guest, path, created_at, seconds in rows}
+
+    def summary(self):
+        """Overlay count per guest and their allocated size on disk"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT user_id, guest, path FROM guest_overlays").fetchall()
+        guests, disk_bytes, users = {}, 0, set()
+        for user, guest, path in rows:
+            users.add(user)
+            guests[guest] = guests.get(guest, 0) + 1
+            try:
+                disk_bytes += os.stat(path).st_blocks * 512
+            except FileNotFoundError:
+                pass
+        return {"overlays": len(rows), "users": len(users), "per_guest": guests, "disk_bytes": disk_bytes}
+
+    def ensure(self, user, guest, dir_deploy):
+        """
+        Overlay of `guest` for `user`, created now if it does not exist yet.
+
+        Returns (path, seconds spent creating it, None when it existed). An
+        existing overlay file is never recreated, it holds the guest's disk.
+        """
+        base = guest_images().get(guest)
+        if base is None:
+            raise KeyError(guest)
+        path = overlay_path(base, dir_deploy)
+        with self._lock(user, guest):
+            if os.path.exists(path):
+                if guest not in self.overlays(user):
+                    self.record(user, guest, path)
+                return path, None
+            seconds = create_overlay(base, path)
+            self.record(user, guest, path, seconds)
+        logger.info(f"Created overlay {path} of {base} for {user} on first use in {seconds:.2f}s")
+        return path, seconds
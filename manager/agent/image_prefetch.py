@@ -0,0 +1,248 @@
+import argparse
+import ctypes
+import ctypes.util
+import json
+import mmap
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+from loguru import logger
+
+from guest_overlays import guest_images
+
+PAGE_SIZE = mmap.PAGESIZE
+# Residency is read and regions are warmed in windows of this size, bounds the mincore vector
+WINDOW_SIZE = 2**30
+# Resident extents closer than this are recorded as one region, fewer and longer reads
+MERGE_GAP = 2**20
+
+PROT_READ = 0x1
+MAP_SHARED = 0x01
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_libc.mmap.restype = ctypes.c_void_p
+_libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+_libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+_libc.mlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+
+_pinned = {}  # image -> [(address, length)] kept mapped and locked while this process runs
+_pinned_lock = threading.Lock()
+
+
+def _map(fd, offset, length):
+    address = _libc.mmap(None, length, PROT_READ, MAP_SHARED, fd, offset)
+    if address in (None, MAP_FAILED):
+        error = ctypes.get_errno()
+        raise OSError(error, f"mmap failed: {os.strerror(error)}")
+    return address
+
+
+def _windows(start, length):
+    """(offset, length) windows of at most WINDOW_SIZE covering [start, start + length)"""
+    end = start + length
+    while start < end:
+        yield start, min(WINDOW_SIZE, end - start)
+        start += WINDOW_SIZE
+
+
+def resident_pages(path):
+    """Per page of `path`, whether it is in the page cache (mincore of a read-only mapping)"""
+    size = os.path.getsize(path)
+    resident = bytearray()
+    with open(path, "rb") as file:
+        for offset, length in _windows(0, size):
+            pages = (length + PAGE_SIZE - 1) // PAGE_SIZE
+            vector = (ctypes.c_ubyte * pages)()
+            address = _map(file.fileno(), offset, length)
+            try:
+                if _libc.mincore(address, length, vector) != 0:
+                    error = ctypes.get_errno()
+                    raise OSError(error, f"mincore failed: {os.strerror(error)}")
+            finally:
+                _libc.munmap(address, length)
+            resident += bytes(page & 1 for page in vector)
+    return resident
+
+
+def resident_extents(resident, merge_gap=MERGE_GAP):
+    """[[start, length], ...] byte extents of resident pages, gaps below merge_gap bridged"""
+    extents = []
+    gap_pages = merge_gap // PAGE_SIZE
+    page = resident.find(1)
+    while page != -1:
+        end = resident.find(0, page)
+        end = len(resident) if end == -1 else end
+        if extents and page - (extents[-1][0] + extents[-1][1]) // PAGE_SIZE <= gap_pages:
+            extents[-1][1] = end * PAGE_SIZE - extents[-1][0]
+        else:
+            extents.append([page * PAGE_SIZE, (end - page) * PAGE_SIZE])
+        page = resident.find(1, end)
+    return extents
+
+
+def profile_path(profile_dir, guest):
+    return os.path.join(profile_dir, f"{guest}.json")
+
+
+def record_profile(guest, image, profile_dir):
+    """
+    Save the regions of `image` now in the page cache as the access profile of `guest`.
+
+    Record after a guest boot that started from a cold cache (e.g. the first boot
+    after an agent restart), so the profile holds what a boot actually reads.
+    """
+    resident = resident_pages(image)
+    stat = os.stat(image)
+    profile = {
+        "image": image,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "recorded_at": time.time(),
+        "regions": resident_extents(resident),
+    }
+    os.makedirs(profile_dir, exist_ok=True)
+    with open(profile_path(profile_dir, guest), "w") as file:
+        json.dump(profile, file)
+    hot = sum(length for _, length in profile["regions"])
+    logger.info(f"Recorded prefetch profile of {guest}: {len(profile['regions'])} regions, {hot / 2**20:.1f} MiB")
+    return profile
+
+
+def load_profile(guest, image, profile_dir):
+    """Recorded regions of `image`, None without a profile or when the image changed since"""
+    try:
+        with open(profile_path(profile_dir, guest), "r") as file:
+            profile = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+    stat = os.stat(image)
+    if profile.get("image") != image or profile.get("size") != stat.st_size or profile.get("mtime") != stat.st_mtime:
+        logger.warning(f"Prefetch profile of {guest} is stale, {image} changed since it was recorded")
+        return None
+    return profile["regions"]
+
+
+def warm(image, regions=None):
+    """
+    Read `regions` (default: the whole image) of `image` into the page cache.
+
+    Each window is mapped, advised MADV_WILLNEED so the kernel reads ahead in
+    large requests, then touched page by page to wait for the data.
+    """
+    size = os.path.getsize(image)
+    regions = regions if regions is not None else [[0, size]]
+    started = time.monotonic()
+    warmed = 0
+    with open(image, "rb") as file:
+        for start, length in regions:
+            length = min(length, size - start)
+            for offset, window in _windows(start, length):
+                # mmap offsets must be page aligned, recorded regions already are
+                with mmap.mmap(file.fileno(), window, access=mmap.ACCESS_READ, offset=offset) as mapping:
+                    mapping.madvise(mmap.MADV_WILLNEED)
+                    for page in range(0, window, PAGE_SIZE):
+                        mapping[page]
+                warmed += window
+    seconds = time.monotonic() - started
+    logger.info(f"Warmed {warmed / 2**20:.1f} MiB of {image} in {seconds:.2f}s")
+    return {"bytes": warmed, "seconds": round(seconds, 3)}
+
+
+def pin(image, regions):
+    """
+    Lock `regions` of `image` in memory (mlock) for as long as this process runs.
+
+    Needs CAP_IPC_LOCK or a large enough RLIMIT_MEMLOCK; on failure the regions
+    stay warm but evictable.
+    """
+    with _pinned_lock:
+        if image in _pinned:
+            return True
+        mappings = []
+        with open(image, "rb") as file:
+            try:
+                for start, length in regions:
+                    for offset, window in _windows(start, length):
+                        address = _map(file.fileno(), offset, window)
+                        mappings.append((address, window))
+                        if _libc.mlock(address, window) != 0:
+                            error = ctypes.get_errno()
+                            raise OSError(error, f"mlock failed: {os.strerror(error)}")
+            except OSError as e:
+                logger.warning(f"Could not pin {image} in memory: {e}")
+                for address, window in mappings:
+                    _libc.munmap(address, window)
+                return False
+        _pinned[image] = mappings
+    return True
+
+
+def prefetch(profile_dir=None, pin_regions=None):
+    """Warm (and with PREFETCH_PIN=on pin) every GUEST_OS_LIST base image, profiled regions only when recorded"""
+    profile_dir = profile_dir or os.getenv("PREFETCH_PROFILE_DIR", "prefetch_profiles")
+    pin_regions = pin_regions if pin_regions is not None else os.getenv("PREFETCH_PIN", "off") == "on"
+    report = {}
+    for guest, image in guest_images().items():
+        try:
+            regions = load_profile(guest, image, profile_dir)
+            report[guest] = warm(image, regions)
+            report[guest]["profiled"] = regions is not None
+            if pin_regions:
+                report[guest]["pinned"] = pin(image, regions or [[0, os.path.getsize(image)]])
+        except OSError as e:
+            logger.error(f"Prefetch of {image} failed: {e}")
+    return report
+
+
+def status(profile_dir=None):
+    """Per base image: size, bytes resident in the page cache, and resident share of the profile"""
+    profile_dir = profile_dir or os.getenv("PREFETCH_PROFILE_DIR", "prefetch_profiles")
+    report = {}
+    for guest, image in guest_images().items():
+        try:
+            resident = resident_pages(image)
+            regions = load_profile(guest, image, profile_dir)
+        except OSError as e:
+            report[guest] = {"image": image, "error": str(e)}
+            continue
+        entry = {
+            "image": image,
+            "size": os.path.getsize(image),
+            "resident_bytes": sum(resident) * PAGE_SIZE,
+            "pinned": image in _pinned,
+        }
+        if regions is not None:
+            hot_pages = [
+                page for start, length in regions
+                for page in range(start // PAGE_SIZE, min((start + length) // PAGE_SIZE, len(resident)))
+            ]
+            entry["profile_bytes"] = len(hot_pages) * PAGE_SIZE
+            entry["profile_resident"] = round(sum(resident[page] for page in hot_pages) / (len(hot_pages) or 1), 3)
+        report[guest] = entry
+    return report
+
+
+if __name__ == "__main__":
+    load_dotenv("../.env", override=True)
+    parser = argparse.ArgumentParser(description="Keep guest base images in the page cache")
+    parser.add_argument("--profile-dir", default=os.getenv("PREFETCH_PROFILE_DIR", "prefetch_profiles"))
+    sub = parser.add_subparsers(dest="command", required=True)
+    record_cmd = sub.add_parser("record", help="save what is cached now as the access profile")
+    record_cmd.add_argument("guests", nargs="*", help="default: every guest of GUEST_OS_LIST")
+    sub.add_parser("warm", help="read the profiled regions (or whole images) into the cache")
+    sub.add_parser("status", help="show page cache residency")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        images = guest_images()
+        for guest in args.guests or images:
+            record_profile(guest, images[guest], args.profile_dir)
+    elif args.command == "warm":
+        # Pinned pages are released when this process exits, pinning belongs in stats.py
+        print(json.dumps(prefetch(args.profile_dir, pin_regions=False), indent=2))
+    else:
+        print(json.dumps(status(args.profile_dir), indent=2))
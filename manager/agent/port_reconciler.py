@@ -0,0 +1,133 @@
+import argparse
+import json
+import os
+import socket
+import time
+
+import docker
+from docker.errors import DockerException
+from dotenv import load_dotenv
+from loguru import logger
+
+from resource_manager import PortManager
+
+CONTAINER_PREFIX = "code-server-"
+
+
+def container_user(name):
+    """User of a `code-server-{user}-{hash}` container, None for other containers"""
+    if not name.startswith(CONTAINER_PREFIX):
+        return None
+    user, sep, _ = name[len(CONTAINER_PREFIX):].rpartition("-")
+    return user if sep else None
+
+
+def published_ports(container):
+    """Host ports the container publishes (also known for stopped containers)"""
+    bindings = container.attrs.get("HostConfig", {}).get("PortBindings") or {}
+    return {
+        int(binding["HostPort"])
+        for host_bindings in bindings.values()
+        for binding in host_bindings or []
+        if binding.get("HostPort")
+    }
+
+
+def port_in_use(port):
+    """Bind test: True if something on the host already listens on `port`"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        try:
+            sock.bind(("0.0.0.0", port))
+        except OSError:
+            return True
+    return False
+
+
+def reconcile(port_manager=None, client=None, grace_period=300, dry_run=False):
+    """
+    Compare port_allocations with the ports code-server containers actually publish.
+
+    - orphaned: allocations older than `grace_period` seconds whose user has no
+      container (removed outside the UI); released unless `dry_run`, or unless a
+      bind test shows something else holds one of the ports
+    - conflicts: containers publishing ports outside their user's range, or
+      without any allocation, and orphaned ranges held by foreign processes
+    - fragmentation: free space summary after the sweep
+    """
+    port_manager = port_manager or PortManager()
+    client = client or docker.from_env()
+    started = time.monotonic()
+
+    allocations = port_manager.get_allocations()
+    containers = {}
+    for container in client.containers.list(all=True, filters={"name": CONTAINER_PREFIX}):
+        user = container_user(container.name)
+        if user is not None:
+            containers[user] = container
+
+    report = {"checked": len(allocations), "containers": len(containers), "released": [], "conflicts": []}
+
+    for user, container in containers.items():
+        ports = published_ports(container)
+        allocation = allocations.get(user)
+        if allocation is None:
+            # Containers behind the reverse proxy (PROXY_MODE) publish nothing and need no allocation
+            if ports:
+                report["conflicts"].append({"user": user, "reason": "container has no allocation", "ports": sorted(ports)})
+            continue
+        outside = sorted(port for port in ports if not allocation["start_port"] <= port <= allocation["end_port"])
+        if outside:
+            report["conflicts"].append({"user": user, "reason": "ports outside allocation", "ports": outside})
+
+    now = time.time()
+    for user, allocation in allocations.items():
+        if user in containers:
+            continue
+        # Allocations are made right before the container is created, leave in-flight ones alone
+        if allocation["allocated_at"] and now - allocation["allocated_at"] < grace_period:
+            continue
+        busy = [
+            port for port in range(allocation["start_port"], allocation["end_port"] + 1) if port_in_use(port)
+        ]
+        if busy:
+            report["conflicts"].append({"user": user, "reason": "orphaned range in use on host", "ports": busy})
+            continue
+        # Look again right before releasing, the user may have started provisioning meanwhile
+        if client.containers.list(all=True, filters={"name": f"{CONTAINER_PREFIX}{user}-"}):
+            continue
+        if not dry_run:
+            port_manager.deallocate_ports(user)
+        report["released"].append({"user": user, **allocation})
+
+    report["fragmentation"] = port_manager.fragmentation()
+    report["duration_s"] = round(time.monotonic() - started, 3)
+    return report
+
+
+def run_reconcile(grace_period=None, dry_run=False):
+    """Reconcile and log a summary, errors are logged rather than raised (for the scheduler)"""
+    grace_period = grace_period if grace_period is not None else int(os.getenv("PORT_RECONCILE_GRACE", 300))
+    try:
+        report = reconcile(grace_period=grace_period, dry_run=dry_run)
+    except (DockerException, OSError) as e:
+        logger.error(f"Port reconciliation failed: {e}")
+        return None
+
+    fragmentation = report["fragmentation"]
+    logger.info(
+        f"Port reconciliation: {report['checked']} allocations, {report['containers']} containers, "
+        f"{len(report['released'])} released, {len(report['conflicts'])} conflicts, "
+        f"{fragmentation['free_gaps']} free gaps (fragmentation {fragmentation['fragmentation']})"
+    )
+    for conflict in report["conflicts"]:
+        logger.warning(f"Port conflict for {conflict['user']}: {conflict['reason']} {conflict['ports']}")
+    return report
+
+
+if __name__ == "__main__":
+    load_dotenv("../.env", override=True)
+    parser = argparse.ArgumentParser(description="Release leaked port ranges and report conflicts")
+    parser.add_argument("--grace-period", type=int, default=int(os.getenv("PORT_RECONCILE_GRACE", 300)))
+    parser.add_argument("--dry-run", action="store_true", help="report only, release nothing")
+    args = parser.parse_args()
+    print(json.dumps(run_reconcile(args.grace_period, args.dry_run), indent=2))
@@ -0,0 +1,509 @@
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+import docker
+import docker.errors
+import toml
+from dotenv import load_dotenv
+from loguru import logger
+
+from guest_overlays import OverlayIndex, create_overlays, guest_images, overlay_mode, overlay_path, overlay_token
+from resource_manager import PortManager
+from template_catalog import current_version, record_version, version_root, workdir_version
+from workdir_provisioner import MANIFEST_FILE, ensure_mounted, is_complete, provision_workdir, verify_workdir
+
+# Steps of a provisioning job, in order
+STEPS = ("workdir", "overlays", "image", "ports", "container")
+
+
+def generate_user_hash(username: str) -> str:
+    # Create SHA-256 hash of username
+    hash_obj = hashlib.sha256(username.encode())
+
+    # Get first 16 characters of hexadecimal hash
+    return hash_obj.hexdigest()[:16]
+
+
+def get_contianer_name(user):
+    name = f"code-server-{user}-{generate_user_hash(user)}"
+    return name
+
+
+def user_workdir(user):
+    return os.getenv("WORKDIR_DEPLOY", "/home/vms/") + f"{user}-{generate_user_hash(user)}"
+
+
+def is_proxy_mode():
+    return os.getenv("PROXY_MODE", "off") == "on"
+
+
+def get_machine_ip():
+    """
+    Get both local and public IP addresses of the machine.
+    Returns a tuple of (local_ip, public_ip)
+    """
+    # Get local IP
+    try:
+        # Create a socket object
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Doesn't actually connect but helps get local IP
+        s.connect(('8.8.8.8', 80))
+        local_ip = s.getsockname()[0]
+        s.close()
+    except Exception as e:
+        local_ip = "Could not determine local IP: " + str(e)
+
+    # Get public IP
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect(("8.8.8.8", 80))
+        public_ip = s.getsockname()[0]
+        s.close()
+    except Exception as e:
+        public_ip = "Could not determine public IP: " + str(e)
+
+    # return "127.0.0.1", "127.0.0.1"
+    return local_ip, public_ip
+
+
+def stats_port():
+    """Port of the stats server, `server.stats_port` of .streamlit/config.toml"""
+    config_path = os.path.join('.streamlit', 'config.toml')
+    if os.path.exists(config_path):
+        config = toml.load(config_path)
+        return config.get('server', {}).get('stats_port', 8511)
+    return 8511
+
+
+def is_valid_dir(dir):
+    if not os.path.exists(dir):
+        return False, "Destination directory does not exist."
+    if not os.path.isdir(dir):
+        return False, "Destination path is not a directory."
+    if not os.listdir(dir):
+        return False, "Destination directory is empty."
+    return True, "Destination directory is valid."
+
+
+def is_valid_sign(dir):
+    signature_file = f"{dir}" + "/signature.txt"
+    if not os.path.exists(signature_file):
+        return False, "Signature file does not exist."
+    with open(signature_file, 'r') as file:
+        content = file.read()
+        if "Timestamp:" not in content or "Unique Hash:" not in content:
+            return False, "Signature file is missing required content."
+    return True, "Signature file is valid."
+
+
+def setup_workdir(user, dir_template, dir_deploy, template_version=None, progress=None, lowerdir=None):
+    """
+    Provision the user workdir unless a complete one exists, raises on failure.
+
+    An overlay workdir is remounted on `lowerdir` (default `dir_template`),
+    the template version it was provisioned from.
+    """
+    progress = progress or (lambda fraction, text: None)
+    ensure_mounted(lowerdir or dir_template, dir_deploy)
+
+    valid_dir, dir_error = is_valid_dir(dir_deploy)
+    valid_copy, copy_error = verify_workdir(dir_deploy)
+    valid_sign, sign_error = is_valid_sign(dir_deploy)
+
+    # Workdirs set up before manifests existed only carry the signature
+    legacy = valid_sign and not os.path.exists(os.path.join(dir_deploy, MANIFEST_FILE))
+    if valid_dir and (valid_copy or legacy):
+        logger.success("Valid workdir exists")
+        return
+    if valid_dir and is_complete(dir_deploy):
+        # Provisioned before, template entries missing now were deleted by the user
+        logger.warning(f"{copy_error} Provisioned before, left as the user changed it")
+        return
+
+    logger.warning(f"{dir_error}, {copy_error}")
+
+    # reflink clone, overlay mount or plain copy, whatever the filesystem allows
+    provision_workdir(dir_template, f"{dir_deploy}", progress)
+
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    # Generate a unique hash (using UUID)
+    unique_hash = hashlib.sha256(str(uuid.uuid4()).encode()).hexdigest()
+
+    if template_version:
+        record_version(dir_deploy, template_version)
+
+    progress(1.0, "Setting up signature...")
+    # Create a signature file in the destination directory
+    signature_file_path = os.path.join(dir_deploy, 'signature.txt')
+    with open(signature_file_path, 'w') as signature_file:
+        signature_file.write(f"Timestamp: {timestamp}\n")
+        signature_file.write(f"Unique Hash: {unique_hash}\n")
+
+
+def _claimer_running(pid):
+    """Whether the agent process `pid` that claimed a job still runs, never for this process"""
+    if not pid or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # exists, owned by another user
+    return True
+
+
+class ProvisioningQueue:
+    """
+    Persistent queue of container provisioning jobs, shared by the UI (submits
+    and polls) and the worker in stats.py (runs them).
+
+    At most one queued or running job exists per user, enforced by a partial
+    unique index, so submitting twice returns the job already in progress.
+    A running job records the pid of the agent that claimed it, only jobs of
+    agents no longer running are requeued. Every step's duration is kept in
+    provisioning_steps.
+    """
+
+    def __init__(self, db_path="provisioning.db"):
+        self.db_path = db_path
+        self._last_progress = {}
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS provisioning_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    step TEXT,
+                    progress REAL NOT NULL DEFAULT 0,
+                    message TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    updated_at REAL,
+                    claimed_by INTEGER
+                )
+            """)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(provisioning_jobs)")]
+            if "claimed_by" not in columns:
+                # Running jobs from before the column existed keep NULL and count as interrupted
+                conn.execute("ALTER TABLE provisioning_jobs ADD COLUMN claimed_by INTEGER")
+            conn.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS provisioning_active_user
+                ON provisioning_jobs (user_id) WHERE state IN ('queued', 'running')
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS provisioning_steps (
+                    job_id INTEGER NOT NULL,
+                    step TEXT NOT NULL,
+                    started_at REAL NOT NULL,
+                    seconds REAL,
+                    PRIMARY KEY (job_id, step)
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def submit(self, user):
+        """Queue provisioning for `user`, or return the id of the job already active"""
+        with self._connect() as conn:
+            try:
+                cursor = conn.execute(
+                    "INSERT INTO provisioning_jobs (user_id, state, message, created_at) VALUES (?, 'queued', ?, ?)",
+                    (user, "Waiting for a provisioning worker...", time.time()),
+                )
+                logger.info(f"Queued provisioning job {cursor.lastrowid} for {user}")
+                return cursor.lastrowid
+            except sqlite3.IntegrityError:
+                row = conn.execute(
+                    "SELECT id FROM provisioning_jobs WHERE user_id = ? AND state IN ('queued', 'running')", (user,)
+                ).fetchone()
+                return row["id"]
+
+    def claim(self):
+        """Take the oldest queued job for this worker, None when the queue is empty"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id, user_id FROM provisioning_jobs WHERE state = 'queued' ORDER BY id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            conn.execute(
+                "UPDATE provisioning_jobs SET state = 'running', started_at = ?, updated_at = ?, claimed_by = ? WHERE id = ?",
+                (now, now, os.getpid(), row["id"]),
+            )
+            return row["id"], row["user_id"]
+
+    def requeue_interrupted(self):
+        """
+        Put back jobs left running by a stopped agent, every step is safe to repeat.
+
+        Jobs claimed by another agent process that is still running are left
+        alone. Called before this process' workers start, so its own pid
+        (reused from a stopped agent) also marks a job as interrupted.
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute("SELECT id, claimed_by FROM provisioning_jobs WHERE state = 'running'").fetchall()
+            stale = [row["id"] for row in rows if not _claimer_running(row["claimed_by"])]
+            conn.executemany(
+                "UPDATE provisioning_jobs SET state = 'queued', claimed_by = NULL, "
+                "message = 'Resuming after agent restart...' WHERE id = ?",
+                [(job_id,) for job_id in stale],
+            )
+        if stale:
+            logger.warning(f"Requeued {len(stale)} interrupted provisioning jobs")
+        if len(rows) > len(stale):
+            logger.info(f"{len(rows) - len(stale)} provisioning jobs are still running in another agent process")
+
+    def progress(self, job_id, fraction, message):
+        """Update the progress of the running step, written at most once per second"""
+        now = time.monotonic()
+        if fraction < 1 and now - self._last_progress.get(job_id, 0) < 1:
+            return
+        self._last_progress[job_id] = now
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE provisioning_jobs SET progress = ?, message = ?, updated_at = ? WHERE id = ?",
+                (fraction, message, time.time(), job_id),
+            )
+
+    @contextmanager
+    def step(self, job_id, step, message):
+        started = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE provisioning_jobs SET step = ?, progress = 0, message = ?, updated_at = ? WHERE id = ?",
+                (step, message, started, job_id),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO provisioning_steps (job_id, step, started_at) VALUES (?, ?, ?)",
+                (job_id, step, started),
+            )
+        try:
+            yield
+        finally:
+            # Failed steps keep their duration too, the stats show where time went either way
+            with self._connect() as conn:
+                conn.execute(
+                    "UPDATE provisioning_steps SET seconds = ? WHERE job_id = ? AND step = ?",
+                    (time.time() - started, job_id, step),
+                )
+
+    def finish(self, job_id, error=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE provisioning_jobs SET state = ?, error = ?, finished_at = ?, progress = ?, message = ? WHERE id = ?",
+                ("failed" if error else "done", error, time.time(), 0 if error else 1,
+                 "Provisioning failed" if error else "Container is ready", job_id),
+            )
+        self._last_progress.pop(job_id, None)
+
+    def job(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM provisioning_jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            steps = conn.execute(
+                "SELECT step, seconds FROM provisioning_steps WHERE job_id = ? ORDER BY started_at", (job_id,)
+            ).fetchall()
+        job = dict(row)
+        job["steps"] = {step["step"]: step["seconds"] for step in steps}
+        return job
+
+    def latest_job(self, user):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id FROM provisioning_jobs WHERE user_id = ? ORDER BY id DESC LIMIT 1", (user,)
+            ).fetchone()
+        return self.job(row["id"]) if row else None
+
+    def step_stats(self, since=None):
+        """Per step: count, mean, p50, p90 and max seconds (failed steps included), over jobs created after `since`"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT s.step, s.seconds FROM provisioning_steps s JOIN provisioning_jobs j ON j.id = s.job_id "
+                "WHERE s.seconds IS NOT NULL AND j.created_at >= ?",
+                (since or 0,),
+            ).fetchall()
+            states = conn.execute(
+                "SELECT state, COUNT(*) FROM provisioning_jobs WHERE created_at >= ? GROUP BY state", (since or 0,)
+            ).fetchall()
+        durations = {}
+        for step, seconds in rows:
+            durations.setdefault(step, []).append(seconds)
+        stats = {}
+        for step in STEPS:
+            values = sorted(durations.get(step, []))
+            if values:
+                stats[step] = {
+                    "count": len(values),
+                    "mean": round(sum(values) / len(values), 3),
+                    "p50": round(values[len(values) // 2], 3),
+                    "p90": round(values[min(len(values) - 1, int(len(values) * 0.9))], 3),
+                    "max": round(values[-1], 3),
+                }
+        return {"jobs": {state: count for state, count in states}, "steps": stats}
+
+
+def provision(queue, job_id, user):
+    """Run every step of provisioning `user`'s container, each one safe to repeat after an interruption"""
+    # Load environment variables from .env file
+    load_dotenv("../.env", override=True)
+    client = docker.from_env()
+    container_name = get_contianer_name(user)
+
+    env = {}
+    env["PUID"] = os.geteuid()
+    env["PGID"] = os.getegid()
+    env["TZ"] = "Etc/UTC"
+    env["DEFAULT_WORKSPACE"] = os.getenv("DEFAULT_WORKSPACE", "/config/workspace")
+    env["SUDO_PASSWORD"] = os.getenv("SUDO_PASSWORD", "abc")
+
+    docker_image_name = os.getenv("DOCKER_IMAGE", "cxl.io/dev/code-server")
+    docker_image_tag = os.getenv("DOCKER_TAG", "latest")
+    image_name = f"{docker_image_name}:{docker_image_tag}"
+
+    dir_template = os.getenv("WORKDIR_TEMPLATE", "/opt/cxl/")
+    template_version = None
+    dir_deploy = user_workdir(user)
+    lowerdir = None
+    if os.getenv("TEMPLATE_CATALOG"):
+        # Versioned templates, later versions reach this workdir through template_catalog rollout
+        template_version, dir_template = current_version(os.getenv("TEMPLATE_CATALOG"))
+        # An overlay workdir stays mounted on the version it was provisioned from
+        recorded = workdir_version(dir_deploy)
+        if recorded:
+            lowerdir = version_root(os.getenv("TEMPLATE_CATALOG"), recorded)
+
+    with queue.step(job_id, "workdir", "Setting up your workdir..."):
+        setup_workdir(
+            user, dir_template, dir_deploy, template_version,
+            lambda fraction, text: queue.progress(job_id, fraction, text),
+            lowerdir,
+        )
+
+    with queue.step(job_id, "overlays", "Preparing guest OS disks..."):
+        images = guest_images()
+        if overlay_mode() == "lazy":
+            # the container calls ensure-guest-overlay before booting a guest, see stats.py /ensure_overlay
+            env["OVERLAY_USER"] = user
+            env["OVERLAY_TOKEN"] = overlay_token(user)
+            env["OVERLAY_HOOK_URL"] = os.getenv("OVERLAY_HOOK_URL") or f"http://{get_machine_ip()[0]}:{stats_port()}/ensure_overlay"
+        elif client.containers.list(all=True, filters={"name": container_name}):
+            # created by an earlier run of this job, the overlays already hold guest state
+            pass
+        else:
+            # create overlay for guest os provided, all at once
+            created = create_overlays(list(images.values()), dir_deploy)
+            index = OverlayIndex()
+            for guest, image in images.items():
+                path = overlay_path(image, dir_deploy)
+                index.record(user, guest, path, created[path])
+
+    # Pulled before ports are allocated: the port reconciler frees ranges without a container
+    # after PORT_RECONCILE_GRACE, which a slow pull between the two steps could exceed
+    with queue.step(job_id, "image", f"Pulling {image_name}..."):
+        try:
+            client.images.get(image_name)
+        except docker.errors.ImageNotFound:
+            logger.warning(f"Pulling image {image_name}...")
+            client.images.pull(image_name)
+
+    ports = {}
+    with queue.step(job_id, "ports", "Allocating ports..."):
+        # In proxy mode nothing is published, the proxy reaches the container on its bridge IP
+        if not is_proxy_mode():
+            # Returns the existing range when this job already allocated one
+            new_ports = PortManager().allocate_ports(user)
+            if new_ports is None:
+                raise RuntimeError("No free port range on this agent")
+            start_port = int(new_ports["start_port"])
+            ports[os.getenv("CODE_PORT", 8443)] = start_port
+            ports[os.getenv("GUEST_OS_SSH_PORT", 22)] = start_port + 1
+            ports[os.getenv("GUEST_OS_SPICE_PORT", 3001)] = start_port + 2
+            ports[os.getenv("OPENCXL_FM_UI_PORT", 3000)] = start_port + 3
+            ports[os.getenv("OPENCXL_FM_PORT", 8000)] = start_port + 4
+
+    volumes = {
+        "/dev/kvm": {"bind": "/dev/kvm", "mode": "rw"},
+        "/opt/os/guestos_base": {"bind": "/opt/os/guestos_base", "mode": "ro"},
+        os.path.join(dir_deploy, "guestos"): {"bind": os.getenv("GUEST_OS_MOUNT"), "mode": "rw"},
+        os.path.join(dir_deploy, "code/config"): {"bind": os.getenv("CODE_CONFIG_MOUNT"), "mode": "rw"},
+        os.path.join(dir_deploy, "qvp"): {"bind": os.getenv("QVP_BINARY_MOUNT"), "mode": "rw"},
+        os.path.join(dir_deploy, "tools"): {"bind": os.getenv("TOOLS_MOUNT"), "mode": "ro"},
+        os.path.join(dir_deploy, "tools/ARMCompiler6.16"): {"bind": "/usr/local/ARMCompiler6.16", "mode": "ro"},
+    }
+    os.makedirs(os.path.join(dir_deploy, "guestos"), exist_ok=True)
+
+    with queue.step(job_id, "container", "Starting your container..."):
+        try:
+            container = client.containers.get(container_name)
+            logger.info(f"Container {container_name} exists, starting it")
+            container.start()
+        except docker.errors.NotFound:
+            container = client.containers.run(
+                image=image_name,
+                name=container_name,
+                ports=ports,
+                volumes=volumes,
+                environment=env,
+                detach=True,
+                cpu_count=int(os.getenv("DOCKER_CPU", 2)),
+                cpu_percent=int(os.getenv("DOCKER_CPU_PERCENT", 100)),
+                mem_limit=os.getenv("DOCKER_MEM_LMT", "2g"),
+                memswap_limit=os.getenv("DOCKER_MEM_SWAP", "3g"),
+                hostname=os.getenv("DOCKER_HOSTNAME", "cxl-qvp"),
+                privileged=True,
+            )
+        logger.success(f"Container created successfully: {container.name}")
+
+
+def run_worker(queue, stop=None, poll_interval=1.0):
+    """Claim and run provisioning jobs until `stop` is set, one at a time per worker thread"""
+    while not (stop and stop.is_set()):
+        claimed = queue.claim()
+        if claimed is None:
+            time.sleep(poll_interval)
+            continue
+        job_id, user = claimed
+        started = time.monotonic()
+        try:
+            provision(queue, job_id, user)
+        except Exception as e:
+            logger.error(f"Provisioning job {job_id} for {user} failed: {e}")
+            queue.finish(job_id, error=str(e))
+            continue
+        queue.finish(job_id)
+        job = queue.job(job_id)
+        logger.info(
+            f"Provisioned {user} in {time.monotonic() - started:.2f}s: "
+            + ", ".join(f"{step} {seconds:.2f}s" for step, seconds in job["steps"].items() if seconds is not None)
+        )
+
+
+def start_workers(queue=None, workers=None):
+    """Requeue jobs interrupted by a restart, then start the worker threads (from stats.py)"""
+    queue = queue or ProvisioningQueue()
+    workers = workers or int(os.getenv("PROVISION_WORKERS", 2))
+    # Jobs of this process can't be running yet, requeue those of stopped agents
+    queue.requeue_interrupted()
+    for _ in range(workers):
+        threading.Thread(target=run_worker, args=(queue,), daemon=True).start()
+    logger.info(f"Started {workers} provisioning workers")
+    return queue
@@ -0,0 +1,219 @@
+import asyncio
+import os
+import time
+
+import docker
+from docker.errors import DockerException
+from dotenv import load_dotenv
+from loguru import logger
+
+from port_reconciler import CONTAINER_PREFIX, container_user
+
+MAX_HEAD_SIZE = 64 * 1024
+
+
+def service_ports():
+    """Container side port of each service reachable through the proxy"""
+    return {
+        "code": int(os.getenv("CODE_PORT", 8443)),
+        "ssh": int(os.getenv("GUEST_OS_SSH_PORT", 22)),
+        "spice": int(os.getenv("GUEST_OS_SPICE_PORT", 3001)),
+        "fm-ui": int(os.getenv("OPENCXL_FM_UI_PORT", 3000)),
+        "fm": int(os.getenv("OPENCXL_FM_PORT", 8000)),
+    }
+
+
+def proxy_urls(user, agent_ip):
+    """How a user reaches each service through the proxy of `agent_ip`"""
+    port = int(os.getenv("PROXY_PORT", 8600))
+    domain = os.getenv("PROXY_DOMAIN")
+    proxy = f"{agent_ip}:{port}"
+    if domain:
+        code_url = f"http://code-{user}.{domain}:{port}/"
+        fm_ui_url = f"http://fm-ui-{user}.{domain}:{port}/"
+    else:
+        code_url = f"http://{proxy}/u/{user}/code/"
+        fm_ui_url = f"http://{proxy}/u/{user}/fm-ui/"
+    return {
+        "code": code_url,
+        "fm-ui": fm_ui_url,
+        "ssh": f'ssh -o ProxyCommand="nc -X connect -x {proxy} %h %p" root@{user}.ssh',
+        "spice": f"remote-viewer --spice-proxy=http://{proxy} spice://{user}.spice:{service_ports()['spice']}",
+    }
+
+
+def container_ip(container):
+    """Bridge network IP of a container"""
+    settings = container.attrs["NetworkSettings"]
+    return settings.get("IPAddress") or next(
+        (net.get("IPAddress") for net in settings["Networks"].values() if net.get("IPAddress")),
+        None,
+    )
+
+
+class ContainerResolver:
+    """Maps users to the bridge IP of their running code-server container"""
+
+    def __init__(self, ttl=10.0, miss_interval=1.0):
+        self.ttl = ttl
+        self.miss_interval = miss_interval
+        self._client = None
+        self._ips = {}
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _load(self):
+        if self._client is None:
+            self._client = docker.from_env()
+        ips = {}
+        for container in self._client.containers.list(filters={"name": CONTAINER_PREFIX}):
+            user = container_user(container.name)
+            ip = container_ip(container)
+            if user is not None and ip:
+                ips[user] = ip
+        return ips
+
+    async def lookup(self, user):
+        age = time.monotonic() - self._loaded_at
+        # Reload when stale, or on a miss (new container) but at most every miss_interval
+        if age > self.ttl or (user not in self._ips and age > self.miss_interval):
+            async with self._lock:
+                if time.monotonic() - self._loaded_at > self.miss_interval:
+                    try:
+                        self._ips = await asyncio.to_thread(self._load)
+                    except DockerException as e:
+                        logger.error(f"Failed listing containers: {e}")
+                    self._loaded_at = time.monotonic()
+        return self._ips.get(user)
+
+
+class ReverseProxy:
+    """
+    Single port front for every user container of this agent.
+
+    - HTTP and WebSocket, routed by host name `{service}-{user}.{PROXY_DOMAIN}`
+      or by path `/u/{user}/{service}/...` (prefix stripped)
+    - any TCP service (SSH, SPICE) through HTTP CONNECT to `{user}.{service}`,
+      as sent by `nc -X connect` or `remote-viewer --spice-proxy`
+
+    Only user containers are reachable, CONNECT to other hosts is refused.
+    """
+
+    def __init__(self, resolver, ports, domain=None):
+        self.resolver = resolver
+        self.ports = ports
+        self.domain = domain
+        # Longest service names first, so "fm-ui-bob" is not read as service "fm", user "ui-bob"
+        self._services = sorted(ports, key=len, reverse=True)
+
+    def route_host(self, host):
+        if not self.domain or not host:
+            return None
+        host = host.split(":", 1)[0].lower()
+        suffix = "." + self.domain.lower()
+        if not host.endswith(suffix):
+            return None
+        label = host[:-len(suffix)]
+        for service in self._services:
+            if label.startswith(service + "-"):
+                return label[len(service) + 1:], service
+        return None
+
+    async def handle(self, reader, writer):
+        try:
+            await self._handle(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.LimitOverrunError:
+            return await self._respond(writer, 431, "Request Header Fields Too Large")
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ", 2)
+        except ValueError:
+            return await self._respond(writer, 400, "Bad Request")
+
+        if method == "CONNECT":
+            user, _, service = target.rsplit(":", 1)[0].rpartition(".")
+            upstream = await self._open(user, service)
+            if upstream is None:
+                return await self._respond(writer, 404, "Not Found")
+            writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+            return await self._pipe(reader, writer, *upstream)
+
+        headers = [line for line in lines[1:] if line]
+        host = next((line.split(":", 1)[1].strip() for line in headers if line.lower().startswith("host:")), None)
+        route = self.route_host(host)
+        if route is None:
+            # Path routing: /u/{user}/{service}/rest
+            parts = target.split("/", 4)
+            if len(parts) < 4 or parts[1] != "u" or not parts[2]:
+                return await self._respond(writer, 404, "Not Found")
+            if len(parts) == 4:
+                # Services use relative links, they need the trailing slash
+                return await self._respond(writer, 301, "Moved Permanently", {"Location": target + "/"})
+            route = (parts[2], parts[3])
+            target = "/" + parts[4]
+            upgrade = any(line.lower().startswith("upgrade:") for line in headers)
+            if not upgrade:
+                # Next request on this connection may be for another user, have the client reconnect
+                headers = [line for line in headers if not line.lower().startswith("connection:")]
+                headers.append("Connection: close")
+
+        upstream = await self._open(*route)
+        if upstream is None:
+            return await self._respond(writer, 502, "Bad Gateway")
+        up_reader, up_writer = upstream
+        up_writer.write(("\r\n".join([f"{method} {target} {version}", *headers]) + "\r\n\r\n").encode("latin-1"))
+        await self._pipe(reader, writer, up_reader, up_writer)
+
+    async def _open(self, user, service):
+        port = self.ports.get(service)
+        ip = await self.resolver.lookup(user) if user and port else None
+        if ip is None:
+            return None
+        try:
+            return await asyncio.open_connection(ip, port)
+        except OSError as e:
+            logger.warning(f"Failed connecting to {service} of {user} at {ip}:{port}: {e}")
+            return None
+
+    async def _pipe(self, reader, writer, up_reader, up_writer):
+        async def copy(src, dst):
+            try:
+                while data := await src.read(65536):
+                    dst.write(data)
+                    await dst.drain()
+                if dst.can_write_eof():
+                    dst.write_eof()
+            except (ConnectionError, OSError):
+                dst.close()
+
+        try:
+            await asyncio.gather(copy(reader, up_writer), copy(up_reader, writer))
+        finally:
+            up_writer.close()
+
+    async def _respond(self, writer, status, reason, headers=None):
+        lines = [f"HTTP/1.1 {status} {reason}", "Content-Length: 0", "Connection: close"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+
+async def serve(host, port):
+    proxy = ReverseProxy(ContainerResolver(), service_ports(), os.getenv("PROXY_DOMAIN"))
+    server = await asyncio.start_server(proxy.handle, host, port, limit=MAX_HEAD_SIZE)
+    logger.info(f"Reverse proxy listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    load_dotenv("../.env", override=True)
+    asyncio.run(serve("0.0.0.0", int(os.getenv("PROXY_PORT", 8600))))
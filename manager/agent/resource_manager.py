@@ -1,107 +1,277 @@
+import os
 import sqlite3
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from contextlib import contextmanager
 from loguru import logger
 
+# Host ports used per user: code-server, ssh, spice, fabric manager UI, fabric manager
+PORTS_PER_USER = 5
+
+
+class _PortIndex:
+    """
+    In-memory view of one port_allocations table.
+
+    Holds the allocations by user and the free gaps of [port_base, port_max]
+    twice: ordered by start port (to merge neighbours on release) and by size
+    (for best-fit lookup), so both allocation and release are a bisect away.
+    """
+
+    def __init__(self, conn, port_base, port_max):
+        self.conn = conn
+        self.port_base = port_base
+        self.port_max = port_max
+        self.lock = threading.Lock()
+        self.data_version = None
+        self.allocations = {}  # user_id -> (start_port, end_port)
+        self._starts = []  # free gap start ports, sorted
+        self._ends = {}  # free gap start -> end
+        self._by_size = []  # (gap size, start), sorted
+
+    def refresh(self):
+        """Rebuild from the table if another connection changed it since the last look"""
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self.data_version:
+            self.rebuild()
+            self.data_version = data_version
+
+    def rebuild(self):
+        rows = self.conn.execute(
+            "SELECT user_id, start_port, end_port FROM port_allocations ORDER BY start_port"
+        ).fetchall()
+        self.allocations = {user_id: (start, end) for user_id, start, end in rows}
+        self._starts, self._ends, self._by_size = [], {}, []
+        next_free = self.port_base
+        for _, start, end in rows:
+            if start > next_free:
+                self._add_gap(next_free, min(start - 1, self.port_max))
+            next_free = max(next_free, end + 1)
+        if next_free <= self.port_max:
+            self._add_gap(next_free, self.port_max)
+
+    def _add_gap(self, start, end):
+        if start > end:
+            return
+        insort(self._starts, start)
+        self._ends[start] = end
+        insort(self._by_size, (end - start + 1, start))
+
+    def _remove_gap(self, start):
+        end = self._ends.pop(start)
+        del self._starts[bisect_left(self._starts, start)]
+        del self._by_size[bisect_left(self._by_size, (end - start + 1, start))]
+        return end
+
+    def find(self, size):
+        """Start of the smallest free gap that fits `size` ports (lowest port on ties)"""
+        i = bisect_left(self._by_size, (size, -1))
+        return self._by_size[i][1] if i < len(self._by_size) else None
+
+    def gap_sizes(self):
+        """Sizes of all free gaps, smallest first"""
+        return [size for size, _ in self._by_size]
+
+    def take(self, user_id, start, end):
+        gap_start = self._starts[bisect_right(self._starts, start) - 1]
+        gap_end = self._remove_gap(gap_start)
+        self._add_gap(gap_start, start - 1)
+        self._add_gap(end + 1, gap_end)
+        self.allocations[user_id] = (start, end)
+
+    def release(self, user_id):
+        start, end = self.allocations.pop(user_id)
+        start, end = max(start, self.port_base), min(end, self.port_max)
+        if start > end:
+            return
+        # Merge with the free gaps right before and after the released range
+        i = bisect_left(self._starts, start)
+        if i > 0 and self._ends[self._starts[i - 1]] == start - 1:
+            start = self._starts[i - 1]
+            self._remove_gap(start)
+        if end + 1 in self._ends:
+            end = self._remove_gap(end + 1)
+        self._add_gap(start, end)
+
+
 class PortManager:
-    def __init__(self, db_path="port_manager.db"):
+    """
+    Hands out a contiguous host port range per user.
+
+    Allocations are persisted in SQLite (WAL) and served from an in-memory
+    free-interval index shared by all PortManager instances of the same
+    database in this process; the index is rebuilt at startup and whenever
+    another process writes the table. Writes run in BEGIN IMMEDIATE
+    transactions, so concurrent allocations never claim the same range.
+    """
+
+    _indexes = {}
+    _indexes_lock = threading.Lock()
+
+    def __init__(self, db_path="port_manager.db", port_base=None, port_max=None, range_size=None):
         self.db_path = db_path
-        self._initialize_db()
+        self.port_base = port_base or int(os.getenv("PORT_BASE", 9000))
+        self.port_max = port_max or int(os.getenv("PORT_MAX", 65535))
+        self.range_size = range_size or int(os.getenv("PORT_RANGE_SIZE", 10))
+        if self.range_size < PORTS_PER_USER:
+            raise ValueError(f"PORT_RANGE_SIZE must be at least {PORTS_PER_USER}")
+        self._index = self._get_index()
+
+    def _get_index(self):
+        key = (os.path.abspath(self.db_path), self.port_base, self.port_max)
+        with PortManager._indexes_lock:
+            if key not in PortManager._indexes:
+                conn = self._initialize_db()
+                PortManager._indexes[key] = _PortIndex(conn, self.port_base, self.port_max)
+            return PortManager._indexes[key]
 
     def _initialize_db(self):
-        """Initialize the database and create the table if it doesn't exist."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS port_allocations (
-                    user_id TEXT PRIMARY KEY,
-                    start_port INTEGER,
-                    end_port INTEGER
-                )
-            ''')
-            conn.commit()
-
-    def allocate_ports(self, user_id, range_size=10):
+        """Open the database and create the table if it doesn't exist."""
+        # Autocommit mode, writes open their own BEGIN IMMEDIATE transaction
+        conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS port_allocations (
+                user_id TEXT PRIMARY KEY,
+                start_port INTEGER,
+                end_port INTEGER,
+                allocated_at REAL
+            )
+        ''')
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(port_allocations)")]
+        if "allocated_at" not in columns:
+            # Rows from before the column existed keep NULL and count as old allocations
+            conn.execute("ALTER TABLE port_allocations ADD COLUMN allocated_at REAL")
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Write transaction over the table and the index.
+
+        BEGIN IMMEDIATE takes the database write lock up front, so no other
+        process can allocate between our gap lookup and our insert. The index
+        is refreshed under that lock and rebuilt if the transaction fails.
+        """
+        index = self._index
+        with index.lock:
+            index.conn.execute("BEGIN IMMEDIATE")
+            try:
+                index.refresh()
+                yield index
+                index.conn.execute("COMMIT")
+            except BaseException:
+                index.conn.execute("ROLLBACK")
+                index.data_version = None
+                raise
+
+    def allocate_ports(self, user_id, range_size=None):
         """Allocate a range of ports to a user."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-
-            # Check if the user already has allocated ports
-            cursor.execute("SELECT * FROM port_allocations WHERE user_id = ?", (user_id,))
-            if cursor.fetchone():
-                logger.error(f"Ports already allocated for user {user_id}.")
-                return self.get_allocated_ports(user_id)
-
-            # Find the next available port range
-            start_port = self._find_available_port_range(range_size)
-            if start_port is None:
-                logger.error("No available port range to allocate.")
-                return None
+        return self.allocate_ports_many([user_id], range_size)[user_id]
 
-            # Allocate the port range to the user
-            end_port = start_port + range_size - 1
-            cursor.execute('''
-                INSERT INTO port_allocations (user_id, start_port, end_port)
-                VALUES (?, ?, ?)
-            ''', (user_id, start_port, end_port))
-            conn.commit()
+    def allocate_ports_many(self, user_ids, range_size=None):
+        """
+        Allocate a range of ports to each of `user_ids` in one transaction.
+        Returns {user_id: {"start_port", "end_port"}}, None for users that did not fit.
+        """
+        range_size = range_size or self.range_size
+        allocated = {}
+        new_rows = []
+        with self._transaction() as index:
+            for user_id in user_ids:
+                # Check if the user already has allocated ports
+                if user_id in index.allocations:
+                    logger.error(f"Ports already allocated for user {user_id}.")
+                    start_port, end_port = index.allocations[user_id]
+                    allocated[user_id] = {"start_port": start_port, "end_port": end_port}
+                    continue
 
+                # Find the best fitting free port range
+                start_port = index.find(range_size)
+                if start_port is None:
+                    logger.error(f"No available port range to allocate for user {user_id}.")
+                    allocated[user_id] = None
+                    continue
+
+                end_port = start_port + range_size - 1
+                index.take(user_id, start_port, end_port)
+                new_rows.append((user_id, start_port, end_port, time.time()))
+                allocated[user_id] = {"start_port": start_port, "end_port": end_port}
+
+            # Allocate the port ranges to the users
+            index.conn.executemany('''
+                INSERT INTO port_allocations (user_id, start_port, end_port, allocated_at)
+                VALUES (?, ?, ?, ?)
+            ''', new_rows)
+
+        for user_id, start_port, end_port, _ in new_rows:
             logger.info(f"Port range allocated for user {user_id}: [{start_port}-{end_port}]")
-            return {"start_port": start_port, "end_port": end_port}
+        return allocated
 
     def deallocate_ports(self, user_id):
         """Deallocate the port range from a user and make it available for reuse."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-
+        with self._transaction() as index:
             # Check if the user has allocated ports
-            cursor.execute("SELECT * FROM port_allocations WHERE user_id = ?", (user_id,))
-            user_ports = cursor.fetchone()
-            if not user_ports:
+            if user_id not in index.allocations:
                 logger.error(f"No ports allocated for user {user_id}.")
                 return None
 
             # Deallocate the port range
-            cursor.execute("DELETE FROM port_allocations WHERE user_id = ?", (user_id,))
-            conn.commit()
+            start_port, end_port = index.allocations[user_id]
+            index.conn.execute("DELETE FROM port_allocations WHERE user_id = ?", (user_id,))
+            index.release(user_id)
 
-            logger.success(f"Port range deallocated for user {user_id}: [{user_ports[1]}-{user_ports[2]}]")
-            return None
+        logger.success(f"Port range deallocated for user {user_id}: [{start_port}-{end_port}]")
+        return None
 
     def get_allocated_ports(self, user_id):
         """Get the allocated port range for a specific user."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM port_allocations WHERE user_id = ?", (user_id,))
-            user_ports = cursor.fetchone()
-            if not user_ports:
-                logger.error(f"No ports allocated for user {user_id}.")
-                return None
+        index = self._index
+        with index.lock:
+            index.refresh()
+            user_ports = index.allocations.get(user_id)
+        if not user_ports:
+            logger.error(f"No ports allocated for user {user_id}.")
+            return None
 
-            return {"start_port": user_ports[1], "end_port": user_ports[2]}
+        return {"start_port": user_ports[0], "end_port": user_ports[1]}
 
     def _get_allocated_port_ranges(self):
         """Get all currently allocated port ranges."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT start_port, end_port FROM port_allocations")
-            return cursor.fetchall()
-
-    def _find_available_port_range(self, range_size):
-        """Find the next available port range of the specified size."""
-        allocated_ranges = self._get_allocated_port_ranges()
-        allocated_ranges.sort()  # Sort by start_port
-
-        # Start searching from port 8000
-        next_start_port = 9000
-
-        for start_port, end_port in allocated_ranges:
-            if next_start_port + range_size - 1 < start_port:
-                # Found a gap large enough for the new range
-                return next_start_port
-            next_start_port = end_port + 1
-
-        # Check if there's enough space after the last allocated range
-        if next_start_port + range_size - 1 <= 65535:
-            return next_start_port
-
-        # No available range found
-        return None
+        index = self._index
+        with index.lock:
+            index.refresh()
+            return sorted(index.allocations.values())
+
+    def get_allocations(self):
+        """All allocations as {user_id: {"start_port", "end_port", "allocated_at"}}."""
+        index = self._index
+        with index.lock:
+            rows = index.conn.execute(
+                "SELECT user_id, start_port, end_port, allocated_at FROM port_allocations"
+            ).fetchall()
+        return {
+            user_id: {"start_port": start_port, "end_port": end_port, "allocated_at": allocated_at}
+            for user_id, start_port, end_port, allocated_at in rows
+        }
+
+    def fragmentation(self):
+        """Free space summary: gap count, free ports, largest gap and fragmentation ratio."""
+        index = self._index
+        with index.lock:
+            index.refresh()
+            gaps = index.gap_sizes()
+            allocated = len(index.allocations)
+        free_ports = sum(gaps)
+        largest = gaps[-1] if gaps else 0
+        return {
+            "allocations": allocated,
+            "free_gaps": len(gaps),
+            "free_ports": free_ports,
+            "largest_free_gap": largest,
+            "ranges_available": sum(size // self.range_size for size in gaps),
+            # 0 when all free ports form one gap, towards 1 as they scatter into small gaps
+            "fragmentation": round(1 - largest / free_ports, 3) if free_ports else 0.0,
+        }
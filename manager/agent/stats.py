@@ -2,22 +2,28 @@ import psutil
 import docker
 from docker.errors import DockerException
 from loguru import logger
-import toml
 import os
 from dotenv import load_dotenv
 from flask import Flask, request, jsonify
 import schedule
+import threading
 import time
 import socket
 import requests
-import os, sys
-from loguru import logger
-from dotenv import load_dotenv
+import sys
 import atexit
+from port_reconciler import CONTAINER_PREFIX, container_user, run_reconcile
+from template_catalog import run_rollout
+from guest_overlays import OverlayIndex, valid_overlay_token
+from image_prefetch import prefetch, status as prefetch_status
+from provisioning import ProvisioningQueue, start_workers, stats_port
 
 load_dotenv(".env", override=True)
 
 app = Flask(__name__)
+last_port_report = {}
+overlay_index = OverlayIndex()
+provisioning_queue = ProvisioningQueue()
 
 def get_machine_ip():
     """
@@ -64,7 +70,7 @@ def unregister_agent(url, agent):
         logger.error(e)
 
 def job():
-    """Register the agent every 5 minutes."""
+    """Register the agent, repeated as a heartbeat to renew its lease."""
     load_dotenv("../.env", override=True)
     manager_ip = os.getenv("MGMT_SERVER_IP")
     manager_port = int(os.getenv("MGMT_SERVER_PORT")) + 1
@@ -83,6 +89,40 @@ def on_exit():
 
 atexit.register(on_exit)
 
+def reconcile_ports():
+    """Release port ranges of removed containers and keep the last report."""
+    global last_port_report
+    report = run_reconcile()
+    if report is not None:
+        last_port_report = report
+
+def run_scheduler():
+    """Run the scheduled jobs (heartbeat, port reconciliation, template rollout, prefetch) in the background."""
+    while True:
+        schedule.run_pending()
+        time.sleep(1)
+
+def in_background(task):
+    """
+    Scheduled job starting `task` on its own thread, so a long run (a throttled
+    rollout, a prefetch) never holds up the lease heartbeat on the scheduler
+    thread. A run still in progress makes the next one skip.
+    """
+    running = threading.Lock()
+
+    def run():
+        try:
+            task()
+        finally:
+            running.release()
+
+    def start():
+        if not running.acquire(blocking=False):
+            logger.warning(f"{task.__name__} is still running, skipping this run")
+            return
+        threading.Thread(target=run, name=task.__name__, daemon=True).start()
+    return start
+
 def get_agent_resources():
     """
     Fetch server resource information (CPU, memory, Docker instances, etc.).
@@ -144,6 +184,85 @@ def get_agent_resources():
     }
 
 
+@app.route('/port_report', methods=['GET'])
+def port_report():
+    """
+    Last port reconciliation summary: released ranges, conflicts, fragmentation.
+    """
+    return jsonify(last_port_report)
+
+def user_guestos_dir(user):
+    """Host directory mounted as GUEST_OS_MOUNT into the user's running container"""
+    client = docker.from_env()
+    for container in client.containers.list(filters={"name": f"{CONTAINER_PREFIX}{user}-"}):
+        if container_user(container.name) != user:
+            continue
+        for mount in container.attrs.get("Mounts", []):
+            if mount.get("Destination") == os.getenv("GUEST_OS_MOUNT"):
+                return mount["Source"]
+    return None
+
+@app.route('/ensure_overlay', methods=['POST'])
+def ensure_overlay():
+    """
+    Create the overlay of a guest on its first launch, called from the user's
+    container (ensure-guest-overlay) with the token it got at creation.
+    """
+    data = request.get_json(silent=True) or {}
+    user, guest = data.get("user", ""), data.get("guest", "")
+    if not valid_overlay_token(user, data.get("token")):
+        return jsonify({"message": "Invalid overlay token"}), 403
+    try:
+        guestos_dir = user_guestos_dir(user)
+    except DockerException as e:
+        logger.error(f"Error looking up container of {user}: {e}")
+        return jsonify({"message": "Container lookup failed"}), 500
+    if guestos_dir is None:
+        return jsonify({"message": f"No running container for {user}"}), 404
+
+    try:
+        path, seconds = overlay_index.ensure(user, guest, os.path.dirname(guestos_dir))
+    except KeyError:
+        return jsonify({"message": f"Unknown guest {guest}"}), 404
+    except Exception as e:
+        logger.error(f"Failed creating overlay of {guest} for {user}: {e}")
+        return jsonify({"message": "Overlay creation failed"}), 500
+
+    # Path as seen inside the container
+    container_path = os.path.join(os.getenv("GUEST_OS_MOUNT"), os.path.relpath(path, guestos_dir))
+    return jsonify({"guest": guest, "path": container_path, "created": seconds is not None, "seconds": seconds})
+
+@app.route('/overlay_index', methods=['GET'])
+def overlay_index_report():
+    """
+    Guest overlays on this agent: count per guest, users, allocated bytes.
+    """
+    return jsonify(overlay_index.summary())
+
+@app.route('/prefetch_status', methods=['GET'])
+def prefetch_report():
+    """
+    Page cache residency of the guest base images, overall and of their recorded boot profile.
+    """
+    return jsonify(prefetch_status())
+
+@app.route('/provisioning_stats', methods=['GET'])
+def provisioning_stats():
+    """
+    Provisioning jobs by state and duration percentiles of each step, optionally ?since=<epoch seconds>.
+    """
+    return jsonify(provisioning_queue.step_stats(request.args.get("since", type=float)))
+
+@app.route('/provisioning_job/<user>', methods=['GET'])
+def provisioning_job(user):
+    """
+    Latest provisioning job of a user with its current step and step durations.
+    """
+    job = provisioning_queue.latest_job(user)
+    if job is None:
+        return jsonify({"message": f"No provisioning job for {user}"}), 404
+    return jsonify(job)
+
 @app.route('/get_resources', methods=['GET'])
 def get_resources():
     """
@@ -154,15 +273,22 @@ def get_resources():
     return jsonify(resources)
 
 if __name__ == "__main__":
-    config_path = os.path.join('.streamlit', 'config.toml')
-    if os.path.exists(config_path):
-        config = toml.load(config_path)
-        port = config.get('server', {}).get('stats_port', 8511)
-    else:
-        port = 8511
+    port = stats_port()
 
     job()
-    # schedule.every(5).seconds.do(job)  # Run the job every 5 minutes
+    # The manager drops agents whose lease is not renewed within AGENT_LEASE_TTL
+    schedule.every(int(os.getenv("AGENT_HEARTBEAT_INTERVAL", 30))).seconds.do(job)
+    schedule.every(int(os.getenv("PORT_RECONCILE_INTERVAL", 600))).seconds.do(in_background(reconcile_ports))
+    if os.getenv("TEMPLATE_CATALOG"):
+        schedule.every(int(os.getenv("TEMPLATE_ROLLOUT_INTERVAL", 3600))).seconds.do(in_background(run_rollout))
+    if os.getenv("PREFETCH", "on") == "on":
+        # Warm the base images right after an agent restart, pinned pages stay locked by this process
+        prefetch_job = in_background(prefetch)
+        prefetch_job()
+        if int(os.getenv("PREFETCH_INTERVAL", 0)):
+            schedule.every(int(os.getenv("PREFETCH_INTERVAL"))).seconds.do(prefetch_job)
+    threading.Thread(target=run_scheduler, daemon=True).start()
+    start_workers(provisioning_queue)
 
     app.run(host="0.0.0.0", port=port)
     
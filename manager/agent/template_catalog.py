@@ -0,0 +1,293 @@
+import argparse
+import errno
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+from dotenv import load_dotenv
+from loguru import logger
+
+from workdir_provisioner import COPY_CHUNK_SIZE, build_manifest, copy_file_data, layers_dir, record_manifest
+
+# Catalog layout: <catalog>/<version>/ template tree, <catalog>/manifests/<version>.json,
+# <catalog>/CURRENT the version new workdirs are provisioned from
+CURRENT_FILE = "CURRENT"
+VERSION_FILE = ".workdir-version"
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(COPY_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def manifest_path(catalog, version):
+    return os.path.join(catalog, "manifests", f"{version}.json")
+
+
+def publish(catalog, version, make_current=True):
+    """Write the content manifest (sizes and sha256) of <catalog>/<version>"""
+    root = version_root(catalog, version)
+    manifest = build_manifest(root)
+    manifest["version"] = version
+    manifest["files"] = {
+        rel: {"size": size, "sha256": file_digest(os.path.join(root, rel))}
+        for rel, size in manifest["files"].items()
+    }
+    os.makedirs(os.path.join(catalog, "manifests"), exist_ok=True)
+    with open(manifest_path(catalog, version), "w") as file:
+        json.dump(manifest, file)
+    if make_current:
+        with open(os.path.join(catalog, CURRENT_FILE), "w") as file:
+            file.write(version + "\n")
+    logger.success(f"Published template {version}: {len(manifest['files'])} files, {manifest['total_bytes']} bytes")
+    return manifest
+
+
+def load_manifest(catalog, version):
+    with open(manifest_path(catalog, version), "r") as file:
+        return json.load(file)
+
+
+def version_root(catalog, version):
+    return os.path.join(catalog, version)
+
+
+def current_version(catalog):
+    """(version, template directory) new workdirs are provisioned from"""
+    with open(os.path.join(catalog, CURRENT_FILE), "r") as file:
+        version = file.read().strip()
+    return version, version_root(catalog, version)
+
+
+def workdir_version(workdir):
+    """Template version of `workdir`, read from the upper layer of an unmounted overlay workdir"""
+    for directory in (workdir, os.path.join(layers_dir(workdir), "upper")):
+        try:
+            with open(os.path.join(directory, VERSION_FILE), "r") as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            continue
+    return None
+
+
+def record_version(workdir, version):
+    with open(os.path.join(workdir, VERSION_FILE), "w") as file:
+        file.write(version + "\n")
+
+
+def diff_manifests(old, new):
+    """Files to write (added or content changed), files and directories to remove, symlinks to (re)create"""
+    changed = [
+        rel for rel, entry in new["files"].items()
+        if old["files"].get(rel, {}).get("sha256") != entry["sha256"]
+    ]
+    removed = [rel for rel in old["files"] if rel not in new["files"]]
+    symlinks = {rel: target for rel, target in new["symlinks"].items() if old["symlinks"].get(rel) != target}
+    # Deepest first, so a dropped tree is removed bottom up
+    removed_dirs = sorted(set(old["dirs"]) - set(new["dirs"]), key=lambda rel: rel.count(os.sep), reverse=True)
+    return {"changed": changed, "removed": removed, "symlinks": symlinks, "dirs": new["dirs"], "removed_dirs": removed_dirs}
+
+
+class Throttle:
+    """Token bucket shared by all rollout workers, limits copied bytes per second"""
+
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self._lock = threading.Lock()
+        self._allowance = bytes_per_second
+        self._last = time.monotonic()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= size
+            wait = -self._allowance / self.rate if self._allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def _copy_throttled(src, dst, throttle):
+    # Charge the whole file up front, the copy itself runs in the kernel
+    throttle.consume(os.path.getsize(src))
+    part = dst + ".part"
+    copy_file_data(src, part)
+    shutil.copystat(src, part)
+    os.replace(part, dst)
+
+
+def upgrade_workdir(workdir, old, new, new_root, throttle):
+    """
+    Apply the delta between the `old` and `new` manifests to one user workdir.
+
+    Files the user modified (content no longer matches `old`) are left alone;
+    the new template file is put next to them as `<file>.<version>.new`. The
+    workdir's manifest is rewritten for the new version, so verify_workdir()
+    checks it against `new`.
+    """
+    started = time.monotonic()
+    delta = diff_manifests(old, new)
+    report = {"files": 0, "bytes": 0, "removed": 0, "conflicts": []}
+
+    def user_modified(rel):
+        path = os.path.join(workdir, rel)
+        entry = old["files"].get(rel)
+        if not os.path.lexists(path):
+            return False
+        return entry is None or os.path.getsize(path) != entry["size"] or file_digest(path) != entry["sha256"]
+
+    for rel in delta["dirs"]:
+        os.makedirs(os.path.join(workdir, rel), exist_ok=True)
+    for rel in delta["changed"]:
+        target = os.path.join(workdir, rel)
+        if user_modified(rel):
+            target = f"{target}.{new['version']}.new"
+            report["conflicts"].append(rel)
+        _copy_throttled(os.path.join(new_root, rel), target, throttle)
+        report["files"] += 1
+        report["bytes"] += new["files"][rel]["size"]
+    for rel in delta["removed"]:
+        if user_modified(rel):
+            report["conflicts"].append(rel)
+        elif os.path.lexists(os.path.join(workdir, rel)):
+            os.remove(os.path.join(workdir, rel))
+            report["removed"] += 1
+    for rel, target in delta["symlinks"].items():
+        path = os.path.join(workdir, rel)
+        if os.path.islink(path):
+            os.remove(path)
+        if not os.path.lexists(path):
+            os.symlink(target, path)
+    for rel in delta["removed_dirs"]:
+        try:
+            os.rmdir(os.path.join(workdir, rel))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            if e.errno != errno.ENOTEMPTY:
+                raise
+            # still holds user files or conflicting ones, kept
+
+    record_manifest(workdir, build_manifest(new_root))
+    record_version(workdir, new["version"])
+    report["seconds"] = round(time.monotonic() - started, 3)
+    return report
+
+
+def rollout(catalog, deploy_root, version=None, concurrency=2, rate_mb=50, skip_running=True):
+    """
+    Upgrade every user workdir below `deploy_root` to `version` (default: CURRENT).
+
+    Workdirs are upgraded `concurrency` at a time with copies throttled to
+    `rate_mb` MB/s overall. Workdirs of running containers are skipped when
+    `skip_running`, so binaries are not swapped under a live session; they
+    are picked up by the next rollout. Workdirs without a recorded version are
+    reported, not touched, as are overlay workdirs: they stay on the version
+    mounted below them.
+    """
+    version = version or current_version(catalog)[0]
+    new = load_manifest(catalog, version)
+    new_root = version_root(catalog, version)
+    throttle = Throttle(rate_mb * 2**20)
+    manifests = {}
+
+    running = set()
+    if skip_running:
+        running = {container.name for container in docker.from_env().containers.list()}
+
+    summary = {"version": version, "upgraded": {}, "skipped": {}, "failed": {}}
+    jobs = {}
+    for name in sorted(os.listdir(deploy_root)):
+        workdir = os.path.join(deploy_root, name)
+        if not os.path.isdir(workdir) or name.endswith(".layers"):
+            continue
+        from_version = workdir_version(workdir)
+        if from_version == version:
+            continue
+        if from_version is None:
+            summary["skipped"][name] = "no template version recorded"
+        elif os.path.isdir(layers_dir(workdir)):
+            summary["skipped"][name] = f"overlay workdir, mounted on {from_version}"
+        elif f"code-server-{name}" in running:
+            summary["skipped"][name] = "container running"
+        elif not os.path.exists(manifest_path(catalog, from_version)):
+            summary["skipped"][name] = f"manifest of {from_version} missing"
+        else:
+            if from_version not in manifests:
+                manifests[from_version] = load_manifest(catalog, from_version)
+            jobs[name] = (workdir, manifests[from_version])
+
+    with ThreadPoolExecutor(max(1, concurrency)) as executor:
+        futures = {
+            name: executor.submit(upgrade_workdir, workdir, old, new, new_root, throttle)
+            for name, (workdir, old) in jobs.items()
+        }
+        for name, future in futures.items():
+            try:
+                summary["upgraded"][name] = future.result()
+            except OSError as e:
+                logger.error(f"Template upgrade of {name} failed: {e}")
+                summary["failed"][name] = str(e)
+
+    moved = sum(report["bytes"] for report in summary["upgraded"].values())
+    logger.info(
+        f"Template rollout to {version}: {len(summary['upgraded'])} upgraded ({moved / 2**20:.1f} MiB), "
+        f"{len(summary['skipped'])} skipped, {len(summary['failed'])} failed"
+    )
+    return summary
+
+
+def run_rollout():
+    """Roll out CURRENT from TEMPLATE_CATALOG, for the stats server scheduler"""
+    catalog = os.getenv("TEMPLATE_CATALOG")
+    if not catalog:
+        return None
+    try:
+        return rollout(
+            catalog,
+            os.getenv("WORKDIR_DEPLOY", "/home/vms/"),
+            concurrency=int(os.getenv("TEMPLATE_ROLLOUT_CONCURRENCY", 2)),
+            rate_mb=float(os.getenv("TEMPLATE_ROLLOUT_RATE_MB", 50)),
+        )
+    except Exception as e:
+        logger.error(f"Template rollout failed: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    load_dotenv("../.env", override=True)
+    parser = argparse.ArgumentParser(description="Versioned workdir templates and rollout to user workdirs")
+    parser.add_argument("--catalog", default=os.getenv("TEMPLATE_CATALOG"))
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    publish_cmd = sub.add_parser("publish", help="write the manifest of <catalog>/<version> and make it current")
+    publish_cmd.add_argument("version")
+    publish_cmd.add_argument("--no-current", action="store_true")
+
+    rollout_cmd = sub.add_parser("rollout", help="upgrade user workdirs to a version")
+    rollout_cmd.add_argument("--version")
+    rollout_cmd.add_argument("--deploy-root", default=os.getenv("WORKDIR_DEPLOY", "/home/vms/"))
+    rollout_cmd.add_argument("--concurrency", type=int, default=int(os.getenv("TEMPLATE_ROLLOUT_CONCURRENCY", 2)))
+    rollout_cmd.add_argument("--rate-mb", type=float, default=float(os.getenv("TEMPLATE_ROLLOUT_RATE_MB", 50)))
+    rollout_cmd.add_argument("--include-running", action="store_true")
+
+    args = parser.parse_args()
+    if args.command == "publish":
+        publish(args.catalog, args.version, make_current=not args.no_current)
+    else:
+        summary = rollout(
+            args.catalog, args.deploy_root, args.version, args.concurrency, args.rate_mb,
+            skip_running=not args.include_running,
+        )
+        print(json.dumps(summary, indent=2))
@@ -0,0 +1,320 @@
+import errno
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from loguru import logger
+
+try:
+    import fcntl
+except ImportError:  # not on Linux, reflinks and overlayfs are unavailable
+    fcntl = None
+
+# ioctl request to share the extents of one file with another (btrfs, XFS reflink=1, ...)
+FICLONE = 0x40049409
+
+PROVISION_METHODS = ("reflink", "overlay", "copy")
+
+# Kept in the workdir: the template file list, and the files done so far
+MANIFEST_FILE = ".workdir-manifest.json"
+PROGRESS_FILE = ".workdir-progress"
+COMPLETE_MARK = "*complete*"
+COPY_CHUNK_SIZE = 4 * 2**20
+# copy_file_range errors that mean "not here", fall back to a regular copy
+_COPY_RANGE_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL)
+
+_reflink_support = {}  # (template st_dev, destination st_dev) -> bool
+
+
+def _no_progress(fraction, text):
+    pass
+
+
+def layers_dir(dst):
+    """Upper and work directories of an overlay provisioned workdir live next to it"""
+    return os.path.normpath(dst) + ".layers"
+
+
+def clone_file(src, dst):
+    """Reflink `src` to `dst`: the new file shares all data blocks until either is modified"""
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copystat(src, dst)
+
+
+def supports_reflink(src_dir, dst_dir):
+    """Probe once per pair of filesystems whether files of src_dir can be cloned into dst_dir"""
+    if fcntl is None:
+        return False
+    key = (os.stat(src_dir).st_dev, os.stat(dst_dir).st_dev)
+    if key not in _reflink_support:
+        sample = next(
+            (os.path.join(root, name) for root, _, files in os.walk(src_dir) for name in files
+             if os.path.isfile(os.path.join(root, name)) and not os.path.islink(os.path.join(root, name))),
+            None,
+        )
+        supported = False
+        if sample is not None:
+            fd, probe = tempfile.mkstemp(dir=dst_dir, prefix=".reflink-probe-")
+            os.close(fd)
+            try:
+                clone_file(sample, probe)
+                supported = True
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY):
+                    raise
+            finally:
+                os.remove(probe)
+        _reflink_support[key] = supported
+    return _reflink_support[key]
+
+
+def reflink_tree(src, dst, progress=_no_progress):
+    """Recreate the tree of `src` in `dst` with every regular file reflinked"""
+    entries = list(os.walk(src))
+    total = sum(len(files) for _, _, files in entries) or 1
+    done = 0
+    for root, dirs, files in entries:
+        target_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target_root, exist_ok=True)
+        for name in dirs:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target_root, name))
+        for name in files:
+            path = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), target)
+            else:
+                clone_file(path, target)
+            done += 1
+            if done % 500 == 0:
+                progress(done / total, f"Cloning {os.path.relpath(root, src)} ...")
+        shutil.copystat(root, target_root)
+
+
+def mount_overlay(src, dst):
+    """Mount `src` read-only below a per-user writable layer at `dst`"""
+    layers = layers_dir(dst)
+    upper = os.path.join(layers, "upper")
+    work = os.path.join(layers, "work")
+    os.makedirs(upper, exist_ok=True)
+    os.makedirs(work, exist_ok=True)
+    os.makedirs(dst, exist_ok=True)
+    subprocess.run(
+        ["mount", "-t", "overlay", "overlay", "-o", f"lowerdir={src},upperdir={upper},workdir={work}", dst],
+        check=True,
+        capture_output=True,
+    )
+
+
+def ensure_mounted(src, dst):
+    """Remount an overlay workdir after a reboot, the mount itself is not persistent"""
+    if os.path.isdir(layers_dir(dst)) and not os.path.ismount(dst):
+        if not os.path.isdir(src):
+            # Another template below the user's layer would change their files unnoticed
+            raise FileNotFoundError(f"Template {src} of overlay workdir {dst} does not exist")
+        logger.info(f"Remounting overlay workdir {dst}")
+        mount_overlay(src, dst)
+
+
+def build_manifest(src):
+    """Every directory, symlink and regular file (with size) below `src`"""
+    manifest = {"dirs": [], "symlinks": {}, "files": {}}
+    for root, dirs, files in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        manifest["dirs"].append(rel_root)
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            rel = os.path.normpath(os.path.join(rel_root, name))
+            if os.path.islink(path):
+                manifest["symlinks"][rel] = os.readlink(path)
+            elif name in files:
+                manifest["files"][rel] = os.stat(path).st_size
+    manifest["total_bytes"] = sum(manifest["files"].values())
+    return manifest
+
+
+def _read_progress(dst):
+    """Files recorded as completely copied, empty when no copy was started"""
+    try:
+        with open(os.path.join(dst, PROGRESS_FILE), "r") as file:
+            # A torn last line (crash while appending) is simply not counted
+            return {line[:-1] for line in file if line.endswith("\n")}
+    except FileNotFoundError:
+        return set()
+
+
+def copy_file_data(src, dst):
+    """
+    Copy the contents of `src` to `dst` inside the kernel with copy_file_range
+    (server side or reflinked where the filesystem can), shutil.copyfile otherwise.
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+                remaining = os.fstat(src_file.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src_file.fileno(), dst_file.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            return
+        except OSError as e:
+            if e.errno not in _COPY_RANGE_UNSUPPORTED:
+                raise
+    shutil.copyfile(src, dst)
+
+
+def _copy_file(src, dst):
+    """Copy through a .part file so a half written file is never taken as done"""
+    part = dst + ".part"
+    copy_file_data(src, part)
+    shutil.copystat(src, part)
+    os.replace(part, dst)
+
+
+def copy_tree(src, dst, progress=_no_progress, workers=None):
+    """
+    Copy `src` into `dst` on a pool of `workers` threads, resuming an earlier attempt.
+
+    The file list comes from a manifest written to `dst` first; each finished
+    file is appended to a progress journal, so an interrupted copy picks up
+    where it stopped. A file already in `dst` is never overwritten, files only
+    reach their final path complete (through .part) and may hold user edits.
+    Progress is reported in bytes of finished files, from the calling thread.
+    """
+    workers = workers or int(os.getenv("WORKDIR_COPY_WORKERS", 8))
+    manifest = build_manifest(src)
+    os.makedirs(dst, exist_ok=True)
+    _write_manifest(dst, manifest)
+
+    done = {rel for rel in manifest["files"] if os.path.lexists(os.path.join(dst, rel))}
+    for rel in manifest["dirs"]:
+        os.makedirs(os.path.join(dst, rel), exist_ok=True)
+    for rel, target in manifest["symlinks"].items():
+        if not os.path.lexists(os.path.join(dst, rel)):
+            os.symlink(target, os.path.join(dst, rel))
+
+    pending = sorted((rel for rel in manifest["files"] if rel not in done), key=manifest["files"].get, reverse=True)
+    copied_bytes = sum(manifest["files"][rel] for rel in done)
+    total_bytes = manifest["total_bytes"] or 1
+    if done:
+        logger.info(f"Resuming copy to {dst}: {len(done)} files already done, {len(pending)} left")
+
+    with open(os.path.join(dst, PROGRESS_FILE), "a") as journal, ThreadPoolExecutor(workers) as executor:
+        # Largest files first so one big file does not run alone at the end
+        futures = {
+            executor.submit(_copy_file, os.path.join(src, rel), os.path.join(dst, rel)): rel
+            for rel in pending
+        }
+        not_done = set(futures)
+        while not_done:
+            finished, not_done = wait(not_done, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in finished:
+                future.result()
+                journal.write(futures[future] + "\n")
+                copied_bytes += manifest["files"][futures[future]]
+            journal.flush()
+            progress(
+                copied_bytes / total_bytes,
+                f"Copying {copied_bytes / 2**30:.2f} of {total_bytes / 2**30:.2f} GiB ...",
+            )
+
+    for rel in manifest["dirs"]:
+        shutil.copystat(os.path.join(src, rel), os.path.join(dst, rel))
+    _mark_complete(dst, manifest)
+
+
+def _write_manifest(dst, manifest):
+    with open(os.path.join(dst, MANIFEST_FILE), "w") as file:
+        json.dump(manifest, file)
+
+
+def _mark_complete(dst, manifest):
+    with open(os.path.join(dst, PROGRESS_FILE), "w") as journal:
+        journal.writelines(rel + "\n" for rel in manifest["files"])
+        journal.write(COMPLETE_MARK + "\n")
+
+
+def record_manifest(dst, manifest):
+    """Record `dst` as completely provisioned with the entries of `manifest`"""
+    _write_manifest(dst, manifest)
+    _mark_complete(dst, manifest)
+
+
+def is_complete(dst):
+    """Whether provisioning of `dst` finished once, whatever the user changed since"""
+    return COMPLETE_MARK in _read_progress(dst)
+
+
+def verify_workdir(dst):
+    """
+    Check that provisioning of `dst` finished: the journal is marked complete
+    and every file and symlink of its manifest exists (lstat). Contents and
+    sizes are not compared, users edit their files.
+    """
+    try:
+        with open(os.path.join(dst, MANIFEST_FILE), "r") as file:
+            manifest = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return False, "Workdir manifest does not exist."
+    copied = _read_progress(dst)
+    if COMPLETE_MARK not in copied:
+        missing = len(set(manifest["files"]) - copied)
+        return False, f"Workdir copy incomplete, {missing} files left."
+    missing = [rel for rel in (*manifest["files"], *manifest["symlinks"]) if not os.path.lexists(os.path.join(dst, rel))]
+    if missing:
+        return False, f"Workdir is missing {len(missing)} files, e.g. {missing[0]}."
+    return True, "Workdir matches its manifest."
+
+
+def provision_workdir(src, dst, progress=_no_progress, method=None):
+    """
+    Populate the user workdir `dst` from the template `src`, cheapest method first.
+
+    - reflink: clone every file (FICLONE), no data is copied until the user
+      changes a file; needs both on the same reflink capable filesystem
+    - overlay: mount the template read-only under a per-user upper layer
+      (`dst`.layers); needs root and overlayfs
+    - copy: full physical copy
+
+    `method` (or WORKDIR_PROVISION) forces one method, "auto" tries them in
+    order; an interrupted copy is always resumed by copying. Returns the
+    method used. Every method leaves a manifest for verify_workdir().
+    """
+    if is_complete(dst):
+        # Entries missing now were deleted by the user, copying again would overwrite their edits
+        raise OSError(f"Workdir {dst} was already provisioned, not provisioning it again")
+    method = method or os.getenv("WORKDIR_PROVISION", "auto")
+    methods = PROVISION_METHODS if method == "auto" else (method,)
+    os.makedirs(dst, exist_ok=True)
+    if os.path.exists(os.path.join(dst, MANIFEST_FILE)):
+        methods = ("copy",)
+
+    for candidate in methods:
+        try:
+            if candidate == "reflink":
+                if method == "auto" and not supports_reflink(src, dst):
+                    continue
+                reflink_tree(src, dst, progress)
+                record_manifest(dst, build_manifest(src))
+            elif candidate == "overlay":
+                if os.listdir(dst):
+                    # Overlay must mount on an empty directory
+                    continue
+                mount_overlay(src, dst)
+                record_manifest(dst, build_manifest(src))
+            else:
+                copy_tree(src, dst, progress)
+        except (OSError, subprocess.CalledProcessError) as e:
+            if method != "auto" or candidate == "copy":
+                raise
+            logger.warning(f"Workdir {candidate} provisioning failed for {dst}, trying next method: {e}")
+            continue
+        logger.success(f"Workdir {dst} provisioned with {candidate}")
+        return candidate
+    raise OSError(f"No provisioning method available for {dst}")
@@ -0,0 +1,146 @@
+# agent_registry.py
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+from loguru import logger
+
+
+class AgentRegistry:
+    """
+    Registry of live agents held in memory, with leases renewed by heartbeats.
+
+    Every register/unregister is appended to a journal file under an exclusive
+    file lock, so writers in several processes never clobber each other. Other
+    processes (the Streamlit app reads, the session server writes) pick up new
+    journal entries on their next read. An agent that stops sending heartbeats
+    drops out once its lease runs out; the journal is compacted down to the
+    live leases every `compact_every` appends.
+    """
+
+    def __init__(self, journal_path: str, lease_ttl: float = 90.0, compact_every: int = 500):
+        self.journal_path = journal_path
+        self.lease_ttl = lease_ttl
+        self.compact_every = compact_every
+        self._lock_path = journal_path + ".lock"
+        self._lock = threading.Lock()
+        self._leases: Dict[str, float] = {}  # agent -> lease expiry (epoch seconds)
+        self._offset = 0
+        self._inode = None
+        self._appended = 0
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        # Lock a side file: compaction replaces the journal, which would drop a lock held on it
+        with open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _apply(self, entry: Dict):
+        if entry["op"] == "register":
+            self._leases[entry["agent"]] = entry["expires"]
+        else:
+            self._leases.pop(entry["agent"], None)
+
+    def _tail(self):
+        """Apply journal entries written since the last read, reload if it was compacted"""
+        try:
+            stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            self._leases.clear()
+            self._offset = 0
+            self._inode = stat.st_ino
+        if stat.st_size == self._offset:
+            return
+
+        with open(self.journal_path, "r") as file:
+            file.seek(self._offset)
+            for line in file:
+                if not line.endswith("\n"):
+                    # Partially written entry, pick it up on the next read
+                    break
+                self._offset += len(line.encode())
+                try:
+                    self._apply(json.loads(line))
+                except (ValueError, KeyError):
+                    logger.warning(f"Skipping malformed agent journal entry: {line.strip()}")
+
+    def _append(self, entry: Dict):
+        with self._file_lock(exclusive=True):
+            self._tail()
+            with open(self.journal_path, "a") as file:
+                file.write(json.dumps(entry) + "\n")
+            self._tail()
+            self._appended += 1
+            if self._appended >= self.compact_every:
+                self._compact()
+
+    def _compact(self):
+        """Rewrite the journal with only the live leases, caller holds the exclusive lock"""
+        now = time.time()
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            for agent, expires in self._leases.items():
+                if expires > now:
+                    file.write(json.dumps({"op": "register", "agent": agent, "expires": expires}) + "\n")
+        os.replace(tmp_path, self.journal_path)
+        self._appended = 0
+        self._inode = None
+        self._tail()
+
+    def refresh(self):
+        """Pick up registrations made by other processes"""
+        with self._lock, self._file_lock(exclusive=False):
+            self._tail()
+
+    def register(self, agent: str) -> bool:
+        """Register or renew the lease of `agent`, returns True if it was not live before"""
+        with self._lock:
+            self._tail()
+            is_new = not self._is_live(agent)
+            self._append({"op": "register", "agent": agent, "expires": time.time() + self.lease_ttl})
+            return is_new
+
+    def unregister(self, agent: str) -> bool:
+        """Drop `agent` from the registry, returns False if it was not live"""
+        with self._lock:
+            self._tail()
+            if not self._is_live(agent):
+                return False
+            self._append({"op": "unregister", "agent": agent})
+            return True
+
+    def _is_live(self, agent: str) -> bool:
+        expires = self._leases.get(agent)
+        return expires is not None and expires > time.time()
+
+    def is_live(self, agent: str) -> bool:
+        self.refresh()
+        with self._lock:
+            return self._is_live(agent)
+
+    def live_agents(self) -> List[str]:
+        """Agents holding an unexpired lease, in registration order"""
+        self.refresh()
+        now = time.time()
+        with self._lock:
+            return [agent for agent, expires in self._leases.items() if expires > now]
+
+    def import_legacy(self, agents_file: str):
+        """One-time import of a plain agents.txt list, each agent gets a fresh lease"""
+        if not os.path.exists(agents_file) or os.path.exists(self.journal_path):
+            return
+        with open(agents_file, "r") as file:
+            agents = [line.strip() for line in file if line.strip()]
+        for agent in agents:
+            self.register(agent)
+        logger.info(f"Imported {len(agents)} agents from {agents_file}")
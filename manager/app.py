@@ -3,14 +3,16 @@ import os, json, hashlib, secrets, time
 import streamlit as st
 from datetime import datetime, timedelta
 from typing import Dict
+from urllib.parse import urlencode
 from dotenv import load_dotenv
 import pandas as pd
 from streamlit_option_menu import option_menu
 
 # project 
-from database import UserDatabase
+from database import DatabaseError, UserDatabase
 from query_agents import query_available_agents
-from session_query_handler import read_agents
+from audit_export import issue_export_token
+from session_query_handler import read_agents, session_port
 
 
 load_dotenv(".env", override=True)
@@ -18,6 +20,8 @@ AGENTS_LIST = os.getenv("AGENTS_LIST")
 agents_list = [server.strip() for server in AGENTS_LIST.split(",")]
 agent_port = int(os.getenv("AGENT_PORT", 8510))
 agent_query_port = agent_port + 1
+user_cache_ttl = int(os.getenv("USER_CACHE_TTL", 30))
+session_server_url = f"http://{os.getenv('MGMT_SERVER_IP')}:{session_port()}"
 
 # Initialize database connection
 db = UserDatabase()
@@ -42,6 +46,31 @@ def init_session_state():
         st.session_state.session_token = None
 
 
+def get_current_user():
+    """
+    Return the logged in user's record, cached in the session.
+
+    The cached record is refetched once it is older than USER_CACHE_TTL seconds or
+    the database reports the user changed (update, approval or deletion).
+    """
+    cached = st.session_state.get("user_cache")
+    version = db.get_user_version(st.session_state.user_id)
+    if (
+        cached
+        and cached["version"] == version
+        and time.monotonic() - cached["fetched_at"] < user_cache_ttl
+    ):
+        return cached["user"]
+
+    user = db.get_user_by_username(st.session_state.username)
+    st.session_state.user_cache = {
+        "user": user,
+        "version": version,
+        "fetched_at": time.monotonic(),
+    }
+    return user
+
+
 def handle_login(username: str, password: str) -> bool:
     user = db.verify_login(username, password)
     if user and user["is_approved"]:
@@ -53,6 +82,7 @@ def handle_login(username: str, password: str) -> bool:
             st.session_state.username = user["username"]
             st.session_state.user_id = user["id"]
             st.session_state.session_token = session_token
+            st.session_state.user_cache = None
 
             db.log_audit(user["id"], "login", {"method": "password"}, get_client_ip())
             return True
@@ -63,10 +93,10 @@ def display_audit_logs():
     st.subheader("Audit Logs")
 
     # Get all users for the filter
-    users = db.get_all_users()
-    user_options = ["All Users"] + [user["username"] for user in users]
+    user_options = ["All Users"] + db.get_usernames()
+    action_options = ["All Actions"] + db.get_audit_action_types()
 
-    col1, col2 = st.columns(2)
+    col1, col2, col3 = st.columns(3)
 
     with col1:
         user_filter = st.selectbox(
@@ -74,6 +104,11 @@ def display_audit_logs():
         )
 
     with col2:
+        action_filter = st.selectbox(
+            "Filter by Action", options=action_options, key="audit_action_filter"
+        )
+
+    with col3:
         n_rows = st.select_slider(
             "Number of rows",
             options=[10, 25, 50, 100, 500],
@@ -81,9 +116,37 @@ def display_audit_logs():
             key="n_rows_slider",
         )
 
+    col1, col2 = st.columns(2)
+
+    with col1:
+        date_range = st.date_input("Time range", value=(), key="audit_date_range")
+
+    with col2:
+        search_term = st.text_input("Search in logs:", "", key="audit_search")
+
+    filters = {
+        "username": user_filter if user_filter != "All Users" else None,
+        "action_type": action_filter if action_filter != "All Actions" else None,
+        "start": None,
+        "end": None,
+        "text": search_term or None,
+    }
+    if search_term and len(date_range) == 0:
+        st.caption("Text search is not indexed, pick a time range to keep it fast on a large log.")
+    if len(date_range) > 0:
+        filters["start"] = datetime.combine(date_range[0], datetime.min.time())
+    if len(date_range) > 1:
+        filters["end"] = datetime.combine(date_range[1], datetime.min.time()) + timedelta(days=1)
+
+    # Keyset paging: a stack of (timestamp, id) cursors, one per page visited
+    filter_key = (tuple(filters.items()), n_rows)
+    if st.session_state.get("audit_filter_key") != filter_key:
+        st.session_state.audit_filter_key = filter_key
+        st.session_state.audit_cursors = [None]
+
     try:
-        logs = db.get_audit_logs(
-            username=user_filter if user_filter != "All Users" else None, limit=n_rows
+        logs = db.search_audit_logs(
+            **filters, before=st.session_state.audit_cursors[-1], limit=n_rows
         )
 
         if logs:
@@ -113,18 +176,9 @@ def display_audit_logs():
             # Create DataFrame
             df = pd.DataFrame(processed_logs)
 
-            # Add search functionality
-            search_term = st.text_input("Search in logs:", "")
-            if search_term:
-                mask = (
-                    df.astype(str)
-                    .apply(lambda x: x.str.contains(search_term, case=False))
-                    .any(axis=1)
-                )
-                df = df[mask]
-
             # Display data info
-            st.write(f"Showing {len(df)} records")
+            page = len(st.session_state.audit_cursors)
+            st.write(f"Showing {len(df)} records (page {page})")
 
             # Display the DataFrame with sorting enabled
             st.dataframe(
@@ -155,15 +209,36 @@ def display_audit_logs():
                 },
             )
 
-            # Add export functionality
-            if st.button("Export to CSV"):
-                csv = df.to_csv(index=False)
-                st.download_button(
-                    label="Download CSV",
-                    data=csv,
-                    file_name="audit_logs.csv",
-                    mime="text/csv",
+            col1, col2, _ = st.columns([1, 1, 6])
+            with col1:
+                if st.button("⬅️ Newer", disabled=page == 1, key="audit_newer"):
+                    st.session_state.audit_cursors.pop()
+                    st.rerun()
+            with col2:
+                if st.button("Older ➡️", disabled=len(logs) < n_rows, key="audit_older"):
+                    last = logs[-1]
+                    st.session_state.audit_cursors.append((last["timestamp"], last["id"]))
+                    st.rerun()
+
+            # Add export functionality, streamed by the session server so the
+            # export covers every matching row, not just this page
+            export_params = {
+                key: value.isoformat() if isinstance(value, datetime) else value
+                for key, value in filters.items()
+                if value
+            }
+            # Links carry a short-lived export-only token, never the session token
+            def export_url(**options):
+                token = issue_export_token(
+                    st.session_state.user_id, st.session_state.username, {**export_params, **options}
                 )
+                return f"{session_server_url}/export_audit_logs?" + urlencode({"token": token})
+
+            col1, col2, _ = st.columns([1, 1, 6])
+            with col1:
+                st.link_button("Export to CSV", export_url(format="csv"))
+            with col2:
+                st.link_button("Export to NDJSON (gzip)", export_url(format="ndjson", gzip="1"))
 
         else:
             st.info("No audit logs found")
@@ -174,6 +249,71 @@ def display_audit_logs():
         )
 
 
+def display_activity_dashboard():
+    """
+    Activity charts, read only from the audit rollup tables so they stay fast
+    however large the raw audit log grows.
+    """
+    st.subheader("Activity")
+
+    col1, col2 = st.columns(2)
+    with col1:
+        today = datetime.now().date()
+        date_range = st.date_input(
+            "Time range",
+            value=(today - timedelta(days=30), today),
+            key="activity_date_range",
+        )
+    with col2:
+        hourly = st.toggle("Hourly buckets", key="activity_hourly")
+
+    if len(date_range) < 2:
+        st.info("Select a start and end date")
+        return
+    start = datetime.combine(date_range[0], datetime.min.time())
+    end = datetime.combine(date_range[1], datetime.min.time()) + timedelta(days=1)
+
+    activity = db.get_audit_activity(start, end, hourly=hourly)
+    if not activity:
+        st.info("No activity in this time range")
+        return
+
+    df = pd.DataFrame(activity)
+    df["total"] = df["total"].astype(int)
+
+    logins = df[df["action_type"] == "login"].set_index("bucket")
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown("**Logins**")
+        st.bar_chart(logins["total"] if not logins.empty else None)
+    with col2:
+        st.markdown("**Active users**")
+        st.line_chart(logins["users"] if not logins.empty else None)
+
+    st.markdown("**Actions by type**")
+    st.bar_chart(df.pivot_table(index="bucket", columns="action_type", values="total", fill_value=0))
+
+    approvals = db.get_audit_activity_by_user("approve_user", start, end)
+    st.markdown("**Approvals per admin**")
+    if approvals:
+        st.dataframe(
+            pd.DataFrame(approvals).rename(columns={"username": "Admin", "total": "Approvals"}),
+            hide_index=True,
+        )
+    else:
+        st.write("No approvals in this time range")
+
+
+def get_server_options():
+    agents_list = read_agents()
+    servers = query_available_agents(agents_list, agent_query_port)
+    return (
+        [server["server_id"] for server in servers]
+        if servers
+        else ["No servers available"]
+    )
+
+
 def display_pending_approvals():
     st.subheader("Pending Approvals")
     pending_users = db.get_pending_users()
@@ -227,63 +367,46 @@ def display_pending_approvals():
             },
         )
 
-        user_col, agent_col = st.columns(2)
-        with user_col:
-            # Create approval form
-            st.subheader("Approve Users")
-            selected_user = st.selectbox(
-                "Select user to approve",
-                options=df["Username"].tolist(),
-                key="user_to_approve",
-            )
-
-            if selected_user:
-                user_id = [
-                    u["id"] for u in pending_users if u["username"] == selected_user
-                ][0]
-
-        with agent_col:
-            with st.form(key=f"approve_form_{user_id}"):
-                agents_list = read_agents()
-                servers = query_available_agents(agents_list, agent_query_port)
-                server_options = (
-                    [server["server_id"] for server in servers]
-                    if servers
-                    else ["No servers available"]
+        # Approve one or many users at once, in a single transaction
+        st.subheader("Approve Users")
+        with st.form(key="approve_form"):
+            user_col, agent_col = st.columns(2)
+            with user_col:
+                selected_users = st.multiselect(
+                    "Select users to approve",
+                    options=df["Username"].tolist(),
+                    key="users_to_approve",
                 )
 
-                # Select server from the list
+            with agent_col:
                 selected_agent = st.selectbox(
-                    "Select a server for the user",
-                    options=server_options,
-                    key=f"server_select_{user_id}",
+                    "Select a server for the users",
+                    options=get_server_options(),
+                    key="server_select_approve",
                 )
 
-                col1, col2 = st.columns([1, 4])
-                with col1:
-                    approve = st.form_submit_button("Approve")
+            approve = st.form_submit_button("Approve")
 
-                if approve:
-                    if selected_agent == "No servers available":
-                        st.error("No servers available for assignment.")
-                    else:
-                        # Update the user's redirect URL with the selected server
-                        db.update_user(
-                            user_id,
-                            {
-                                "is_approved": True,
-                                "redirect_url": f"http://{selected_agent}:{agent_port}",
-                                "metadata": {"approved_by": st.session_state.username},
-                            },
-                        )
-                        db.log_audit(
+            if approve:
+                if not selected_users:
+                    st.error("Select at least one user to approve.")
+                elif selected_agent == "No servers available":
+                    st.error("No servers available for assignment.")
+                else:
+                    # Update the users' redirect URL with the selected server
+                    try:
+                        approved = db.bulk_approve_users(
+                            selected_users,
+                            f"http://{selected_agent}:{agent_port}",
                             st.session_state.user_id,
-                            "approve_user",
-                            {"approved_user": selected_user},
+                            st.session_state.username,
                             get_client_ip(),
                         )
+                    except DatabaseError as e:
+                        st.error(f"Error approving users: {str(e)}")
+                    else:
                         st.success(
-                            f"Approved user {selected_user} and assigned to server {selected_agent}"
+                            f"Approved {approved} user(s) and assigned them to server {selected_agent}"
                         )
                         st.rerun()
     else:
@@ -292,9 +415,45 @@ def display_pending_approvals():
 
 def display_manage_users():
     st.title("Manage Users")
-    users = db.get_all_users()
+
+    sort_columns = {
+        "Username": "username",
+        "Email": "email",
+        "Created At": "created_at",
+        "Last Login": "last_login",
+    }
+    col1, col2, col3, col4 = st.columns([3, 2, 2, 1])
+    with col1:
+        search = st.text_input("Search by username or email prefix", key="users_search")
+    with col2:
+        approved_filter = st.selectbox(
+            "Approval", options=["All", "Approved", "Pending"], key="users_approved_filter"
+        )
+    with col3:
+        sort_label = st.selectbox("Sort by", options=list(sort_columns), key="users_sort")
+    with col4:
+        page_size = st.selectbox("Page size", options=[25, 50, 100, 200], index=1, key="users_page_size")
+
+    approved = {"All": None, "Approved": True, "Pending": False}[approved_filter]
+    total = db.count_users(search=search or None, approved=approved)
+    pages = max(1, -(-total // page_size))
+    # The widget state is set here only, passing value= as well makes Streamlit warn
+    if "users_page" not in st.session_state:
+        st.session_state.users_page = 1
+    elif st.session_state.users_page > pages:
+        st.session_state.users_page = pages
+    page = st.number_input("Page", min_value=1, max_value=pages, key="users_page")
+
+    users = db.get_users_page(
+        offset=(page - 1) * page_size,
+        limit=page_size,
+        sort_by=sort_columns[sort_label],
+        search=search or None,
+        approved=approved,
+    )
 
     if users:
+        st.write(f"Showing {len(users)} of {total} users (page {page} of {pages})")
         df = pd.DataFrame(users)
 
         # Rename columns for better readability
@@ -308,6 +467,7 @@ def display_manage_users():
                 "created_at": "Created At",
             }
         )
+        df = df[["ID", "Username", "Email", "Approved", "Redirect URL", "Created At"]]
 
         # Format the 'Approved' column to show 'Yes' or 'No'
         df["Approved"] = df["Approved"].apply(lambda x: "Yes" if x else "No")
@@ -334,37 +494,94 @@ def display_manage_users():
             },
         )
 
-        # Add a delete user section
-        st.subheader("Delete User")
-        selected_user = st.selectbox(
-            "Select a user to delete",
+        # Add a delete users section
+        st.subheader("Delete Users")
+        selected_users = st.multiselect(
+            "Select users to delete",
             options=df["Username"].tolist(),
-            key="delete_user_selectbox",
+            key="delete_users_multiselect",
         )
 
-        if selected_user:
-            user_id = df[df["Username"] == selected_user]["ID"].values[0]
-
+        if selected_users:
             # Confirmation step before deletion
             confirm_delete = st.checkbox(
-                f"Are you sure you want to delete user '{selected_user}'?",
-                key=f"confirm_delete_{user_id}",
+                f"Are you sure you want to delete {len(selected_users)} user(s)?",
+                key="confirm_delete_users",
             )
 
             if confirm_delete:
-                if st.button("Delete User", key=f"delete_button_{user_id}"):
-                    db.log_audit(
-                        st.session_state.user_id,
-                        "delete_user",
-                        {"deleted_user": selected_user},
-                        get_client_ip(),
-                    )
-                    db.delete_user_by_username(selected_user)
-                    st.success(f"User '{selected_user}' has been deleted.")
-                    st.rerun()  # Refresh the page to update the user list
+                if st.button("Delete Users", key="delete_users_button"):
+                    try:
+                        deleted = db.bulk_delete_users(
+                            selected_users, st.session_state.user_id, get_client_ip()
+                        )
+                    except DatabaseError as e:
+                        st.error(f"Error deleting users: {str(e)}")
+                    else:
+                        st.success(f"{deleted} user(s) have been deleted.")
+                        st.rerun()  # Refresh the page to update the user list
     else:
         st.info("No users found in the database.")
 
+    display_import_users()
+
+
+def display_import_users():
+    st.subheader("Import Users")
+    approve = st.checkbox(
+        "Approve imported users and assign them a server", key="import_approve"
+    )
+    selected_agent = None
+    if approve:
+        selected_agent = st.selectbox(
+            "Server for imported users",
+            options=get_server_options(),
+            key="server_select_import",
+        )
+
+    with st.form("import_users_form"):
+        uploaded = st.file_uploader(
+            "CSV file with columns username, email, password", type="csv"
+        )
+        submit = st.form_submit_button("Import")
+
+    if submit and uploaded is not None:
+        rows = pd.read_csv(uploaded, dtype=str).fillna("")
+        missing = {"username", "email", "password"} - set(rows.columns)
+        if missing:
+            st.error(f"CSV is missing column(s): {', '.join(sorted(missing))}")
+            return
+        if approve and selected_agent == "No servers available":
+            st.error("No servers available for assignment.")
+            return
+
+        users = []
+        for row in rows.itertuples(index=False):
+            if not row.username or not row.email or not row.password:
+                continue
+            user = {
+                "username": row.username.strip(),
+                "password": hashlib.sha256(row.password.encode()).hexdigest(),
+                "email": row.email.strip(),
+                "metadata": {"registration_source": "csv_import"},
+            }
+            if approve:
+                user["is_approved"] = True
+                user["redirect_url"] = f"http://{selected_agent}:{agent_port}"
+                user["metadata"]["approved_by"] = st.session_state.username
+            users.append(user)
+
+        try:
+            created, skipped = db.bulk_create_users(
+                users, st.session_state.user_id, get_client_ip()
+            )
+        except DatabaseError as e:
+            st.error(f"Error importing users: {str(e)}")
+            return
+        st.success(f"Imported {created} user(s)")
+        if skipped:
+            st.warning(f"Skipped existing users: {', '.join(skipped)}")
+
 def display_server_resources():
     """
     Display available servers and their resources in a Streamlit table.
@@ -470,8 +687,8 @@ def main():
             with st.sidebar:                    
                 page = option_menu(
                     menu_title='CXL-QVP',
-                    options=['Home','Users', 'Agents', 'Audit Logs', "Logout"],
-                    icons=['house','people-fill', 'hdd-stack-fill','card-text', 'door-closed'],
+                    options=['Home','Users', 'Agents', 'Audit Logs', 'Activity', "Logout"],
+                    icons=['house','people-fill', 'hdd-stack-fill','card-text', 'graph-up', 'door-closed'],
                     menu_icon='cast',
                     default_index=0,
                     styles={
@@ -480,7 +697,7 @@ def main():
                         }
                     )
         else:
-            user = db.get_user_by_username(st.session_state.username)
+            user = get_current_user()
             if user and user["redirect_url"]:
                 st.success("Redirecting to your assigned application...")
                 url = (
@@ -527,11 +744,14 @@ def main():
     elif page == "Audit Logs" and st.session_state.is_admin:
         display_audit_logs()
 
+    elif page == "Activity" and st.session_state.is_admin:
+        display_activity_dashboard()
+
     elif page == "User Dashboard" and st.session_state.logged_in:
         st.title("User Dashboard")
         st.write(f"Welcome, {st.session_state.username}!")
-        user = db.get_user_by_username(st.session_state.username)
-        if user["redirect_url"]:
+        user = get_current_user()
+        if user and user["redirect_url"]:
             st.write("You will be redirected to your assigned application.")
             url = (
                 user["redirect_url"]
@@ -549,6 +769,7 @@ def main():
         st.session_state.username = None
         st.session_state.user_id = None
         st.session_state.session_token = None
+        st.session_state.user_cache = None
         st.success("Logged out successfully!")
         st.rerun()
 
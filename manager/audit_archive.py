@@ -0,0 +1,111 @@
+# audit_archive.py
+import argparse
+import gzip
+import json
+import os
+import sys
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, Optional
+
+from dotenv import load_dotenv
+from loguru import logger
+
+
+def archive_path(archive_dir: str, partition: str) -> str:
+    return os.path.join(archive_dir, f"audit_log_{partition}.jsonl.gz")
+
+
+def write_archive(path: str, rows: Iterable[Dict]) -> int:
+    """
+    Write audit rows to a gzip compressed JSON-lines archive.
+
+    The file is written under a temporary name and renamed into place, so an
+    archive either exists complete or not at all. Existing archives are never
+    rewritten.
+    """
+    tmp_path = path + ".tmp"
+    count = 0
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as file:
+        for row in rows:
+            file.write(json.dumps(row, default=str) + "\n")
+            count += 1
+    os.replace(tmp_path, path)
+    return count
+
+
+def search_archives(
+    archive_dir: str,
+    text: Optional[str] = None,
+    username: Optional[str] = None,
+    action_type: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> Iterator[Dict]:
+    """Scan archived audit entries offline, oldest archive first"""
+    if not os.path.isdir(archive_dir):
+        return
+    text = text.lower() if text else None
+    for name in sorted(os.listdir(archive_dir)):
+        if not name.endswith(".jsonl.gz"):
+            continue
+        with gzip.open(os.path.join(archive_dir, name), "rt", encoding="utf-8") as file:
+            for line in file:
+                if text and text not in line.lower():
+                    continue
+                row = json.loads(line)
+                if username and row.get("username") != username:
+                    continue
+                if action_type and row.get("action_type") != action_type:
+                    continue
+                timestamp = datetime.fromisoformat(row["timestamp"])
+                if start and timestamp < start:
+                    continue
+                if end and timestamp >= end:
+                    continue
+                yield row
+
+
+def main():
+    load_dotenv(".env", override=True)
+    default_dir = os.getenv("AUDIT_ARCHIVE_DIR", "audit_archive")
+
+    parser = argparse.ArgumentParser(description="Audit log retention and archive search")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    maintain = sub.add_parser("maintain", help="create upcoming partitions, archive and drop expired ones")
+    maintain.add_argument("--retention-days", type=int, default=int(os.getenv("AUDIT_RETENTION_DAYS", 365)))
+    maintain.add_argument("--archive-dir", default=default_dir)
+
+    rollup = sub.add_parser("rollup", help="rebuild activity rollups from the raw audit log")
+    rollup.add_argument("--start", type=datetime.fromisoformat)
+    rollup.add_argument("--end", type=datetime.fromisoformat)
+
+    search = sub.add_parser("search", help="search archived audit entries")
+    search.add_argument("--archive-dir", default=default_dir)
+    search.add_argument("--text")
+    search.add_argument("--username")
+    search.add_argument("--action-type")
+    search.add_argument("--start", type=datetime.fromisoformat)
+    search.add_argument("--end", type=datetime.fromisoformat)
+
+    args = parser.parse_args()
+
+    if args.command == "maintain":
+        from database import UserDatabase
+
+        summary = UserDatabase().maintain_audit_log(args.retention_days, args.archive_dir)
+        logger.success(f"Audit log maintenance done: {summary}")
+    elif args.command == "rollup":
+        from database import UserDatabase
+
+        count = UserDatabase().rebuild_audit_rollups(args.start, args.end)
+        logger.success(f"Rebuilt audit rollups from {count} entries")
+    else:
+        for row in search_archives(
+            args.archive_dir, args.text, args.username, args.action_type, args.start, args.end
+        ):
+            sys.stdout.write(json.dumps(row) + "\n")
+
+
+if __name__ == "__main__":
+    main()
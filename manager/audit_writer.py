@@ -0,0 +1,209 @@
+# audit_writer.py
+import atexit
+import fcntl
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List
+
+from loguru import logger
+
+_STOP = object()
+
+
+class AuditWriter:
+    """
+    Write-behind queue for audit entries.
+
+    Entries are buffered in memory and handed to `flush_fn` as one batch when
+    `batch_size` entries are pending or `flush_interval` seconds have passed
+    since the oldest pending entry. Batches that cannot be written (database
+    down, queue overflow) are appended to a JSON-lines spill file and replayed
+    after the next successful flush.
+    """
+
+    def __init__(
+        self,
+        flush_fn: Callable[[List[Dict]], None],
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        spill_file: str = "audit_spill.jsonl",
+        max_queue: int = 10000,
+    ):
+        self._flush_fn = flush_fn
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.01, flush_interval)
+        self.spill_file = spill_file
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._spill_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, entry: Dict):
+        """Queue an audit entry without waiting on the database"""
+        entry.setdefault("timestamp", datetime.now())
+        if self._closed:
+            self._write_batch([entry])
+            return
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            logger.warning("Audit queue full, spilling entry to disk")
+            self._spill([entry])
+
+    def flush(self, timeout: float = None) -> bool:
+        """Block until every entry queued so far has been written or spilled"""
+        if self._closed:
+            return True
+        if not self._thread.is_alive():
+            logger.error("Audit writer thread is not running, cannot flush")
+            return False
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        """Flush pending entries and stop the writer thread"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        self._replay_spill()
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            try:
+                if item is _STOP:
+                    self._write_batch(batch)
+                    return
+                if isinstance(item, threading.Event):
+                    self._write_batch(batch)
+                    batch, deadline = [], None
+                    item.set()
+                    continue
+                if item is not None:
+                    batch.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+
+                if len(batch) >= self.batch_size or (deadline and time.monotonic() >= deadline):
+                    self._write_batch(batch)
+                    batch, deadline = [], None
+            except Exception as e:
+                # Keep the thread alive, a dead writer would let the queue grow and flush() hang
+                logger.exception(f"Audit writer failed, dropping {len(batch)} entries: {e}")
+                batch, deadline = [], None
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _write_batch(self, batch: List[Dict]):
+        if not batch:
+            return
+        try:
+            self._flush_fn(batch)
+        except Exception as e:
+            logger.error(f"Audit flush of {len(batch)} entries failed, spilling to disk: {e}")
+            self._spill(batch)
+            return
+        self._replay_spill()
+
+    @contextmanager
+    def _spill_locked(self, blocking: bool = True):
+        """
+        Hold the spill file lock, shared by every process using the same spill
+        file. Yields False when not blocking and another process holds it.
+        """
+        with self._spill_lock, open(self.spill_file + ".lock", "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _spill(self, entries: List[Dict]):
+        with self._spill_locked():
+            self._append_spill(entries)
+
+    def _append_spill(self, entries: List[Dict]):
+        with open(self.spill_file, "a") as file:
+            for entry in entries:
+                record = dict(entry)
+                if isinstance(record["timestamp"], datetime):
+                    record["timestamp"] = record["timestamp"].isoformat()
+                file.write(json.dumps(record) + "\n")
+
+    def _replay_spill(self):
+        """
+        Write spilled entries to the database, in one process at a time.
+
+        The spill file is renamed to a name private to this replay before it is
+        read, so entries spilled meanwhile wait for the next replay. Claimed
+        files left by a replay that crashed are picked up as well.
+        """
+        try:
+            with self._spill_locked(blocking=False) as locked:
+                if locked:
+                    self._replay_claimed()
+        except Exception as e:
+            logger.exception(f"Audit spill replay failed: {e}")
+
+    def _replay_claimed(self):
+        if os.path.exists(self.spill_file):
+            claimed = f"{self.spill_file}.{os.getpid()}.{time.time_ns()}.replay"
+            try:
+                os.replace(self.spill_file, claimed)
+            except FileNotFoundError:
+                pass
+
+        # ".replay" is the claim name used before claims were per process
+        replay_files = glob.glob(glob.escape(self.spill_file) + ".replay")
+        replay_files += sorted(glob.glob(glob.escape(self.spill_file) + ".*.replay"))
+        for replay_file in replay_files:
+            entries = []
+            try:
+                with open(replay_file, "r") as file:
+                    for line in file:
+                        if line.strip():
+                            record = json.loads(line)
+                            record["timestamp"] = datetime.fromisoformat(record["timestamp"])
+                            entries.append(record)
+            except FileNotFoundError:
+                continue
+
+            start, failed = 0, False
+            try:
+                for start in range(0, len(entries), self.batch_size):
+                    self._flush_fn(entries[start:start + self.batch_size])
+            except Exception as e:
+                logger.error(f"Audit spill replay failed, keeping {len(entries) - start} entries: {e}")
+                # The lock is held already, append directly
+                self._append_spill(entries[start:])
+                failed = True
+            else:
+                logger.info(f"Replayed {len(entries)} spilled audit entries")
+            try:
+                os.remove(replay_file)
+            except FileNotFoundError:
+                pass
+            if failed:
+                break
@@ -0,0 +1,139 @@
+# connection_pool.py
+import threading
+import time
+from typing import Dict
+
+import mysql.connector
+from mysql.connector.errors import PoolError
+
+# Upper bounds (ms) of the checkout wait time histogram buckets
+WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class PooledConnection:
+    """Connection checked out of a BoundedConnectionPool, close() hands it back"""
+
+    def __init__(self, pool: "BoundedConnectionPool", cnx):
+        self._pool = pool
+        self._cnx = cnx
+
+    def __getattr__(self, name):
+        return getattr(self._cnx, name)
+
+    def close(self):
+        if self._cnx is not None:
+            cnx, self._cnx = self._cnx, None
+            self._pool._release(cnx)
+
+
+class BoundedConnectionPool:
+    """
+    MySQL connection pool that queues callers instead of failing when exhausted.
+
+    Callers wait up to `pool_timeout` seconds for a free connection and get a
+    PoolError after that. Connections idle for longer than
+    `health_check_interval` seconds are pinged on checkout and reconnected if
+    the server dropped them. Usage is tracked in `metrics()`.
+    """
+
+    def __init__(
+        self,
+        pool_name: str = "mypool",
+        pool_size: int = 5,
+        pool_timeout: float = 10.0,
+        health_check_interval: float = 30.0,
+        **connect_args,
+    ):
+        self.pool_name = pool_name
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.health_check_interval = health_check_interval
+        self._connect_args = connect_args
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._lock = threading.Lock()
+        self._idle = []  # (connection, released_at), most recent last
+        self._stats = {
+            "checkouts": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "reconnects": 0,
+            "in_use": 0,
+            "opened": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+        }
+        self._wait_histogram = [0] * (len(WAIT_BUCKETS_MS) + 1)
+
+    def get_connection(self) -> PooledConnection:
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.pool_timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+                self._stats["errors"] += 1
+            raise PoolError(
+                f"Pool '{self.pool_name}' exhausted: no connection free after {self.pool_timeout}s"
+            )
+        waited_ms = (time.monotonic() - started) * 1000
+
+        try:
+            cnx = self._checkout()
+        except Exception:
+            self._slots.release()
+            with self._lock:
+                self._stats["errors"] += 1
+            raise
+
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["in_use"] += 1
+            self._stats["wait_ms_total"] += waited_ms
+            self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], waited_ms)
+            bucket = next(
+                (i for i, bound in enumerate(WAIT_BUCKETS_MS) if waited_ms <= bound),
+                len(WAIT_BUCKETS_MS),
+            )
+            self._wait_histogram[bucket] += 1
+        return PooledConnection(self, cnx)
+
+    def _checkout(self):
+        with self._lock:
+            cnx, released_at = self._idle.pop() if self._idle else (None, None)
+
+        if cnx is None:
+            cnx = mysql.connector.connect(**self._connect_args)
+            with self._lock:
+                self._stats["opened"] += 1
+            return cnx
+
+        if time.monotonic() - released_at > self.health_check_interval and not cnx.is_connected():
+            cnx.reconnect(attempts=1)
+            with self._lock:
+                self._stats["reconnects"] += 1
+        return cnx
+
+    def _release(self, cnx):
+        try:
+            if cnx.in_transaction:
+                cnx.rollback()
+            with self._lock:
+                self._idle.append((cnx, time.monotonic()))
+        except mysql.connector.Error:
+            # Broken connection, drop it and let the next checkout open a new one
+            with self._lock:
+                self._stats["errors"] += 1
+        finally:
+            with self._lock:
+                self._stats["in_use"] -= 1
+            self._slots.release()
+
+    def metrics(self) -> Dict:
+        """Snapshot of pool usage counters and the checkout wait histogram"""
+        with self._lock:
+            stats = dict(self._stats)
+            histogram = list(self._wait_histogram)
+            stats["idle"] = len(self._idle)
+        stats["pool_size"] = self.pool_size
+        stats["wait_ms_avg"] = stats["wait_ms_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        labels = [f"le_{bound}ms" for bound in WAIT_BUCKETS_MS] + ["inf"]
+        stats["wait_histogram"] = dict(zip(labels, histogram))
+        return stats
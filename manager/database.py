@@ -1,15 +1,27 @@
 # db_utilities.py
 import mysql.connector
-from mysql.connector import pooling
 import hashlib
-from datetime import datetime
+import sqlite3
+from collections import Counter
+from datetime import datetime, timedelta
 import json
 import os
-from typing import Dict, List, Tuple, Optional
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple, Optional
+
+from audit_archive import archive_path, write_archive
+from audit_writer import AuditWriter
+from connection_pool import BoundedConnectionPool
+
+# Errors raised by either storage backend
+DatabaseError = (mysql.connector.Error, sqlite3.Error)
 
 class DatabaseConfig:
     # Load database configuration from environment variables or config file
     def __init__(self):
+        self.backend = os.getenv('DB_BACKEND', 'mysql')
+        self.sqlite_path = os.getenv('SQLITE_PATH', 'user_auth.db')
         self.config = {
             'host': os.getenv('DB_HOST', '0.0.0.0'),
             'database': os.getenv('DB_NAME', 'user_auth_db'),
@@ -17,29 +29,89 @@ class DatabaseConfig:
             'password': os.getenv('DB_PASSWORD', '12qwaszx'),
             'port': os.getenv('DB_PORT', 3306),
             'pool_name': 'mypool',
-            'pool_size': 5
+            'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+            'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+            'health_check_interval': float(os.getenv('DB_POOL_HEALTH_CHECK', 30))
+        }
+        self.audit = {
+            'batch_size': int(os.getenv('AUDIT_BATCH_SIZE', 100)),
+            'flush_interval': float(os.getenv('AUDIT_FLUSH_INTERVAL', 1.0)),
+            'spill_file': os.getenv('AUDIT_SPILL_FILE', 'audit_spill.jsonl'),
+        }
+        self.audit_retention = {
+            'retention_days': int(os.getenv('AUDIT_RETENTION_DAYS', 365)),
+            'archive_dir': os.getenv('AUDIT_ARCHIVE_DIR', 'audit_archive'),
         }
 
+
+def _month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(value: datetime) -> datetime:
+    return (value.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def _partition_definition(month: datetime) -> str:
+    return (
+        f"PARTITION p{month:%Y%m} VALUES LESS THAN "
+        f"(UNIX_TIMESTAMP('{_next_month(month):%Y-%m-%d}'))"
+    )
+
 class UserDatabase:
     _instance = None
     _pool = None
+    _audit_writer = None
+    _initialized = False
+    _username_cache = {}
+    _username_cache_lock = threading.Lock()
+    # Bumped on every user change so per-session caches can tell when a record is stale
+    _user_versions = {}
+    _users_generation = 0
+
+    # Activity rollups: table name -> function truncating a timestamp to its bucket
+    AUDIT_ROLLUPS = {
+        'audit_rollup_hourly': lambda ts: ts.replace(minute=0, second=0, microsecond=0),
+        'audit_rollup_daily': lambda ts: ts.replace(hour=0, minute=0, second=0, microsecond=0),
+    }
+
+    USERNAME_CACHE_TTL = 60
+    USER_LIST_COLUMNS = ['id', 'username', 'email', 'is_approved', 'redirect_url', 'status', 'created_at', 'last_login']
+
+    # audit_log is range partitioned by month so expired months can be archived
+    # and dropped without a mass DELETE. Partitioned tables cannot have foreign
+    # keys, and the partitioning column must be part of the primary key.
+    AUDIT_PARTITIONS_AHEAD = 2
 
     def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(UserDatabase, cls).__new__(cls)
+        if UserDatabase._instance is None:
+            if cls is UserDatabase and DatabaseConfig().backend == 'sqlite':
+                from sqlite_database import SQLiteUserDatabase
+                cls = SQLiteUserDatabase
+            UserDatabase._instance = super(UserDatabase, cls).__new__(cls)
             cls._setup_connection_pool()
-        return cls._instance
+        return UserDatabase._instance
 
     @classmethod
     def _setup_connection_pool(cls):
         if cls._pool is None:
             db_config = DatabaseConfig()
-            print(db_config.config)
-            cls._pool = mysql.connector.pooling.MySQLConnectionPool(**db_config.config)
+            print({k: v for k, v in db_config.config.items() if k != 'password'})
+            cls._pool = BoundedConnectionPool(**db_config.config)
+
+    def _get_audit_writer(self) -> AuditWriter:
+        if UserDatabase._audit_writer is None:
+            db_config = DatabaseConfig()
+            UserDatabase._audit_writer = AuditWriter(self._insert_audit_batch, **db_config.audit)
+        return UserDatabase._audit_writer
 
     def _get_connection(self):
         return self._pool.get_connection()
 
+    def get_pool_metrics(self) -> Dict:
+        """Connection pool usage: checkouts, wait times, in-use count and errors"""
+        return self._pool.metrics()
+
     def initialize_database(self):
         """Create necessary tables if they don't exist"""
         create_tables_query = """
@@ -67,15 +139,40 @@ class UserDatabase:
         );
 
         CREATE TABLE IF NOT EXISTS audit_log (
-            id INT AUTO_INCREMENT PRIMARY KEY,
+            id INT AUTO_INCREMENT,
             user_id INT,
             action_type VARCHAR(50),
             action_details JSON,
             ip_address VARCHAR(50),
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, timestamp),
+            KEY idx_audit_timestamp (timestamp),
+            KEY idx_audit_user_ts (user_id, timestamp),
+            KEY idx_audit_action_ts (action_type, timestamp)
+        )
+        PARTITION BY RANGE (UNIX_TIMESTAMP(timestamp)) (
+            PARTITION pmax VALUES LESS THAN MAXVALUE
+        );
+
+        CREATE TABLE IF NOT EXISTS audit_rollup_hourly (
+            bucket DATETIME NOT NULL,
+            action_type VARCHAR(50) NOT NULL,
+            user_id INT NOT NULL,
+            count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, action_type, user_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS audit_rollup_daily (
+            bucket DATETIME NOT NULL,
+            action_type VARCHAR(50) NOT NULL,
+            user_id INT NOT NULL,
+            count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, action_type, user_id)
         );
         """
+        if UserDatabase._initialized:
+            return
+
         conn = self._get_connection()
         try:
             cursor = conn.cursor()
@@ -84,8 +181,13 @@ class UserDatabase:
                     cursor.execute(query)
             conn.commit()
 
+            self._migrate_audit_partitioning(cursor)
+            self._add_audit_partitions(cursor)
+            self._add_audit_indexes(cursor)
+
             # Create default admin if not exists
             self.create_default_admin()
+            UserDatabase._initialized = True
         except Exception as e:
             print(f"Database initialization error: {e}")
             raise
@@ -93,6 +195,156 @@ class UserDatabase:
             cursor.close()
             conn.close()
 
+    def _get_audit_partitions(self, cursor) -> List[str]:
+        cursor.execute("""
+        SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'audit_log'
+        AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+        """)
+        return [row[0] for row in cursor.fetchall()]
+
+    def _has_index(self, cursor, table: str, index: str) -> bool:
+        cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+        """, (table, index))
+        return cursor.fetchone()[0] > 0
+
+    def _migrate_audit_partitioning(self, cursor):
+        """Convert an audit_log created by older releases to the partitioned layout"""
+        if self._get_audit_partitions(cursor):
+            return
+
+        print("Migrating audit_log to monthly partitions, this may take a while")
+        cursor.execute("""
+        SELECT CONSTRAINT_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS
+        WHERE CONSTRAINT_SCHEMA = DATABASE() AND TABLE_NAME = 'audit_log'
+        """)
+        for (constraint,) in cursor.fetchall():
+            cursor.execute(f"ALTER TABLE audit_log DROP FOREIGN KEY `{constraint}`")
+
+        alter = [
+            "MODIFY timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP",
+            "DROP PRIMARY KEY",
+            "ADD PRIMARY KEY (id, timestamp)",
+        ]
+        if not self._has_index(cursor, 'audit_log', 'idx_audit_timestamp'):
+            alter.append("ADD KEY idx_audit_timestamp (timestamp)")
+        cursor.execute(f"ALTER TABLE audit_log {', '.join(alter)}")
+
+        cursor.execute("SELECT MIN(timestamp) FROM audit_log")
+        oldest = cursor.fetchone()[0] or datetime.now()
+        partitions = []
+        month = _month_start(oldest)
+        while month <= datetime.now():
+            partitions.append(_partition_definition(month))
+            month = _next_month(month)
+        partitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+        cursor.execute(
+            "ALTER TABLE audit_log PARTITION BY RANGE (UNIX_TIMESTAMP(timestamp)) "
+            f"({', '.join(partitions)})"
+        )
+
+    def _add_audit_indexes(self, cursor):
+        """Add the audit_log search indexes missing from tables created by older releases"""
+        indexes = {
+            'idx_audit_user_ts': '(user_id, timestamp)',
+            'idx_audit_action_ts': '(action_type, timestamp)',
+        }
+        missing = [
+            f"ADD KEY {name} {columns}"
+            for name, columns in indexes.items()
+            if not self._has_index(cursor, 'audit_log', name)
+        ]
+        if missing:
+            cursor.execute(f"ALTER TABLE audit_log {', '.join(missing)}")
+
+    def _add_audit_partitions(self, cursor) -> List[str]:
+        """Split pmax so the current and upcoming months have their own partition"""
+        existing = set(self._get_audit_partitions(cursor))
+        named = sorted(p for p in existing if p != 'pmax')
+        month = _month_start(datetime.now())
+        if named:
+            month = max(month, _next_month(datetime.strptime(named[-1], 'p%Y%m')))
+
+        last = _month_start(datetime.now())
+        for _ in range(self.AUDIT_PARTITIONS_AHEAD):
+            last = _next_month(last)
+
+        added = []
+        while month <= last:
+            added.append(month)
+            month = _next_month(month)
+        if not added:
+            return []
+
+        definitions = [_partition_definition(m) for m in added]
+        definitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+        cursor.execute(
+            f"ALTER TABLE audit_log REORGANIZE PARTITION pmax INTO ({', '.join(definitions)})"
+        )
+        return [f"p{m:%Y%m}" for m in added]
+
+    def _iter_audit_partition(self, partition: str):
+        query = f"""
+        SELECT a.id, a.user_id, u.username, a.action_type, a.action_details,
+               a.ip_address, a.timestamp
+        FROM audit_log PARTITION ({partition}) a
+        LEFT JOIN users u ON a.user_id = u.id
+        ORDER BY a.timestamp, a.id
+        """
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute(query)
+            for row in cursor:
+                details = row['action_details']
+                row['action_details'] = json.loads(details) if isinstance(details, str) else details
+                row['timestamp'] = row['timestamp'].isoformat()
+                yield row
+        finally:
+            cursor.close()
+            conn.close()
+
+    def maintain_audit_log(self, retention_days: int = None, archive_dir: str = None) -> Dict:
+        """
+        Roll the audit log forward: add upcoming monthly partitions, then export
+        partitions older than the retention window to compressed archives and drop them.
+        """
+        retention = DatabaseConfig().audit_retention
+        retention_days = retention_days if retention_days is not None else retention['retention_days']
+        archive_dir = archive_dir or retention['archive_dir']
+        os.makedirs(archive_dir, exist_ok=True)
+        cutoff = datetime.now() - timedelta(days=retention_days)
+
+        if not self.flush_audit_log(timeout=60):
+            print("Audit writer did not flush within 60s, maintaining without the queued entries")
+        summary = {'added': [], 'archived': {}}
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            summary['added'] = self._add_audit_partitions(cursor)
+            for partition in self._get_audit_partitions(cursor):
+                if partition == 'pmax':
+                    continue
+                if _next_month(datetime.strptime(partition, 'p%Y%m')) > cutoff:
+                    break
+
+                path = archive_path(archive_dir, partition)
+                if os.path.exists(path):
+                    print(f"Archive {path} already written, dropping partition {partition}")
+                    summary['archived'][partition] = 0
+                else:
+                    summary['archived'][partition] = write_archive(
+                        path, self._iter_audit_partition(partition)
+                    )
+                cursor.execute(f"ALTER TABLE audit_log DROP PARTITION {partition}")
+        finally:
+            cursor.close()
+            conn.close()
+        return summary
+
     def create_default_admin(self):
         """Create default admin user if not exists"""
         admin_exists = self.get_user_by_username('admin')
@@ -125,8 +377,9 @@ class UserDatabase:
                 'metadata': json.dumps(metadata)
             })
             conn.commit()
+            self._invalidate_usernames()
             return True
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error creating user: {e}")
             return False
         finally:
@@ -154,13 +407,15 @@ class UserDatabase:
             cursor = conn.cursor()
             cursor.execute(query, (username,))
             conn.commit()
+            self._invalidate_usernames()
+            self._bump_user_version()
             
             # Check if any row was affected
             if cursor.rowcount > 0:
                 return True
             else:
                 return False
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error deleting user: {e}")
             return False
         finally:
@@ -193,8 +448,9 @@ class UserDatabase:
             cursor = conn.cursor()
             cursor.execute(query, values)
             conn.commit()
+            self._bump_user_version(user_id)
             return True
-        except mysql.connector.Error as e:
+        except DatabaseError as e:
             print(f"Error updating user: {e}")
             return False
         finally:
@@ -260,23 +516,401 @@ class UserDatabase:
             cursor.close()
             conn.close()
 
+    def _user_list_filters(
+        self, search: str = None, approved: Optional[bool] = None, exclude_admin: bool = True
+    ) -> Tuple[str, List]:
+        clauses, params = [], []
+        if exclude_admin:
+            clauses.append("is_admin = FALSE")
+        if approved is not None:
+            clauses.append("is_approved = %s")
+            params.append(approved)
+        if search:
+            # Prefix match so the unique indexes on username and email are used
+            clauses.append("(username LIKE %s OR email LIKE %s)")
+            params.extend([f"{search}%", f"{search}%"])
+        where = " WHERE " + " AND ".join(clauses) if clauses else ""
+        return where, params
+
+    def get_users_page(
+        self,
+        offset: int = 0,
+        limit: int = 50,
+        sort_by: str = 'username',
+        descending: bool = False,
+        search: str = None,
+        approved: Optional[bool] = None,
+        exclude_admin: bool = True,
+    ) -> List[Dict]:
+        """Get one page of users with only the listing columns (no password or metadata)"""
+        if sort_by not in self.USER_LIST_COLUMNS:
+            raise ValueError(f"Cannot sort users by {sort_by}")
+        where, params = self._user_list_filters(search, approved, exclude_admin)
+        direction = "DESC" if descending else "ASC"
+        query = (
+            f"SELECT {', '.join(self.USER_LIST_COLUMNS)} FROM users{where}"
+            f" ORDER BY {sort_by} {direction}, id {direction} LIMIT %s OFFSET %s"
+        )
+        params.extend([limit, offset])
+
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+            conn.close()
+
+    def count_users(
+        self, search: str = None, approved: Optional[bool] = None, exclude_admin: bool = True
+    ) -> int:
+        """Count users matching the same filters as get_users_page"""
+        where, params = self._user_list_filters(search, approved, exclude_admin)
+        query = f"SELECT COUNT(*) FROM users{where}"
+
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+            conn.close()
+
+    def get_usernames(self, exclude_admin: bool = True) -> List[str]:
+        """Get all usernames in order, cached for dropdowns"""
+        with self._username_cache_lock:
+            cached = self._username_cache.get(exclude_admin)
+            if cached and cached[0] > time.monotonic():
+                return cached[1]
+
+        query = "SELECT username FROM users"
+        if exclude_admin:
+            query += " WHERE is_admin = FALSE"
+        query += " ORDER BY username"
+
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query)
+            usernames = [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+            conn.close()
+
+        with self._username_cache_lock:
+            self._username_cache[exclude_admin] = (time.monotonic() + self.USERNAME_CACHE_TTL, usernames)
+        return usernames
+
+    def get_user_version(self, user_id: int) -> Tuple[int, int]:
+        """Version of a user record, changes whenever the record is updated or any user deleted"""
+        return (UserDatabase._users_generation, UserDatabase._user_versions.get(user_id, 0))
+
+    def _bump_user_version(self, user_id: int = None):
+        with self._username_cache_lock:
+            if user_id is None:
+                UserDatabase._users_generation += 1
+            else:
+                UserDatabase._user_versions[user_id] = UserDatabase._user_versions.get(user_id, 0) + 1
+
+    def _invalidate_usernames(self):
+        with self._username_cache_lock:
+            self._username_cache.clear()
+
     def log_audit(self, user_id: int, action_type: str, action_details: Dict, ip_address: str):
-        """Log user actions for audit"""
+        """Log user actions for audit, written in the background by the audit writer"""
+        self._get_audit_writer().submit({
+            'user_id': user_id,
+            'action_type': action_type,
+            'action_details': json.dumps(action_details),
+            'ip_address': ip_address,
+        })
+
+    def flush_audit_log(self, timeout: float = None) -> bool:
+        """Wait until queued audit entries are written"""
+        return self._get_audit_writer().flush(timeout)
+
+    def _insert_audit_batch(self, entries: List[Dict]):
+        """Write a batch of audit entries with a single multi-row insert"""
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            self._write_audit_rows(cursor, entries)
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+
+    def _write_audit_rows(self, cursor, entries: List[Dict]):
+        """
+        Insert audit entries on the caller's cursor, inside its transaction,
+        and add them to the activity rollups in the same transaction.
+        """
         query = """
-        INSERT INTO audit_log (user_id, action_type, action_details, ip_address)
+        INSERT INTO audit_log (user_id, action_type, action_details, ip_address, timestamp)
+        VALUES (%s, %s, %s, %s, %s)
+        """
+        rows = [
+            (
+                entry['user_id'],
+                entry['action_type'],
+                entry['action_details'],
+                entry['ip_address'],
+                entry.get('timestamp') or datetime.now()
+            )
+            for entry in entries
+        ]
+        cursor.executemany(query, rows)
+
+        counts = Counter((row[4], row[1], row[0]) for row in rows)
+        self._add_to_rollups(cursor, counts)
+
+    def _rollup_upsert_query(self, table: str) -> str:
+        return f"""
+        INSERT INTO {table} (bucket, action_type, user_id, count)
         VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE count = count + VALUES(count)
         """
-        
+
+    def _add_to_rollups(self, cursor, counts: Counter):
+        """Increment rollup buckets from a Counter keyed by (timestamp, action_type, user_id)"""
+        for table, truncate in self.AUDIT_ROLLUPS.items():
+            buckets = Counter()
+            for (timestamp, action_type, user_id), count in counts.items():
+                if action_type and user_id is not None:
+                    buckets[(truncate(timestamp), action_type, user_id)] += count
+            if buckets:
+                cursor.executemany(
+                    self._rollup_upsert_query(table),
+                    [key + (count,) for key, count in sorted(buckets.items())],
+                )
+
+    def rebuild_audit_rollups(self, start: datetime = None, end: datetime = None) -> int:
+        """
+        Recompute the activity rollups for [start, end) from the raw audit log.
+
+        Used to backfill history written before rollups existed. Both bounds are
+        widened to whole days; `end` defaults to the start of today so buckets
+        still receiving live entries are left alone.
+        """
+        day = self.AUDIT_ROLLUPS['audit_rollup_daily']
+        end = day(end or datetime.now())
         conn = self._get_connection()
         try:
             cursor = conn.cursor()
-            cursor.execute(query, (
-                user_id,
-                action_type,
-                json.dumps(action_details),
-                ip_address
-            ))
+            if start is None:
+                cursor.execute("SELECT timestamp FROM audit_log ORDER BY timestamp LIMIT 1")
+                oldest = cursor.fetchone()
+                if oldest is None:
+                    return 0
+                start = oldest[0]
+            start = day(start)
+
+            counts = Counter()
+            cursor.execute(
+                "SELECT timestamp, action_type, user_id FROM audit_log WHERE timestamp >= %s AND timestamp < %s",
+                (start, end),
+            )
+            for timestamp, action_type, user_id in cursor:
+                counts[(timestamp, action_type, user_id)] += 1
+
+            for table in self.AUDIT_ROLLUPS:
+                cursor.execute(f"DELETE FROM {table} WHERE bucket >= %s AND bucket < %s", (start, end))
+            self._add_to_rollups(cursor, counts)
+            conn.commit()
+            return sum(counts.values())
+        finally:
+            cursor.close()
+            conn.close()
+
+    def get_audit_activity(self, start: datetime, end: datetime, hourly: bool = False) -> List[Dict]:
+        """Entries and distinct users per bucket and action type, read from the rollups only"""
+        table = 'audit_rollup_hourly' if hourly else 'audit_rollup_daily'
+        query = f"""
+        SELECT bucket, action_type, SUM(count) AS total, COUNT(DISTINCT user_id) AS users
+        FROM {table}
+        WHERE bucket >= %s AND bucket < %s
+        GROUP BY bucket, action_type
+        ORDER BY bucket
+        """
+
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute(query, (start, end))
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+            conn.close()
+
+    def get_audit_activity_by_user(self, action_type: str, start: datetime, end: datetime) -> List[Dict]:
+        """Entries of one action type per user (e.g. approvals per admin), read from the daily rollup"""
+        query = """
+        SELECT u.username, SUM(r.count) AS total
+        FROM audit_rollup_daily r
+        JOIN users u ON r.user_id = u.id
+        WHERE r.action_type = %s AND r.bucket >= %s AND r.bucket < %s
+        GROUP BY u.username
+        ORDER BY total DESC
+        """
+
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute(query, (action_type, start, end))
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+            conn.close()
+
+    def _select_users_by_username(self, cursor, usernames: List[str], columns: str = "id, username") -> List[Dict]:
+        placeholders = ", ".join(["%s"] * len(usernames))
+        cursor.execute(f"SELECT {columns} FROM users WHERE username IN ({placeholders})", usernames)
+        return cursor.fetchall()
+
+    def bulk_create_users(self, users: List[Dict], admin_id: int, ip_address: str) -> Tuple[int, List[str]]:
+        """
+        Create many users in one transaction with a single batched insert.
+
+        Users whose username or email already exists are skipped and returned,
+        the rest are created together with one audit entry each.
+        """
+        if not users:
+            return 0, []
+        query = """
+        INSERT INTO users (username, password, email, is_admin, is_approved, redirect_url, metadata)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """
+
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            usernames = [user['username'] for user in users]
+            emails = [user['email'] for user in users]
+            cursor.execute(
+                f"SELECT username, email FROM users WHERE username IN ({', '.join(['%s'] * len(users))})"
+                f" OR email IN ({', '.join(['%s'] * len(users))})",
+                usernames + emails,
+            )
+            taken = set()
+            for row in cursor.fetchall():
+                taken.update([row['username'], row['email']])
+
+            new_users, skipped = [], []
+            for user in users:
+                if user['username'] in taken or user['email'] in taken:
+                    skipped.append(user['username'])
+                else:
+                    taken.update([user['username'], user['email']])
+                    new_users.append(user)
+            if not new_users:
+                return 0, skipped
+
+            cursor.executemany(query, [
+                (
+                    user['username'],
+                    user['password'],
+                    user['email'],
+                    user.get('is_admin', False),
+                    user.get('is_approved', False),
+                    user.get('redirect_url'),
+                    json.dumps(user.get('metadata', {}))
+                )
+                for user in new_users
+            ])
+            self._write_audit_rows(cursor, [
+                {
+                    'user_id': admin_id,
+                    'action_type': 'create_user',
+                    'action_details': json.dumps({'created_user': user['username'], 'source': 'bulk_import'}),
+                    'ip_address': ip_address,
+                }
+                for user in new_users
+            ])
+            conn.commit()
+            self._invalidate_usernames()
+            return len(new_users), skipped
+        except DatabaseError as e:
+            conn.rollback()
+            print(f"Error creating users: {e}")
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+    def bulk_approve_users(
+        self, usernames: List[str], redirect_url: str, admin_id: int, admin_username: str, ip_address: str
+    ) -> int:
+        """Approve users and assign them to a server in one transaction"""
+        if not usernames:
+            return 0
+
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            users = self._select_users_by_username(cursor, usernames)
+            if not users:
+                return 0
+            placeholders = ", ".join(["%s"] * len(users))
+            cursor.execute(
+                f"UPDATE users SET is_approved = TRUE, redirect_url = %s, metadata = %s WHERE id IN ({placeholders})",
+                [redirect_url, json.dumps({'approved_by': admin_username})] + [user['id'] for user in users],
+            )
+            self._write_audit_rows(cursor, [
+                {
+                    'user_id': admin_id,
+                    'action_type': 'approve_user',
+                    'action_details': json.dumps({'approved_user': user['username'], 'redirect_url': redirect_url}),
+                    'ip_address': ip_address,
+                }
+                for user in users
+            ])
             conn.commit()
+            for user in users:
+                self._bump_user_version(user['id'])
+            return len(users)
+        except DatabaseError as e:
+            conn.rollback()
+            print(f"Error approving users: {e}")
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+    def bulk_delete_users(self, usernames: List[str], admin_id: int, ip_address: str) -> int:
+        """Delete users in one transaction"""
+        if not usernames:
+            return 0
+
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            users = self._select_users_by_username(cursor, usernames)
+            if not users:
+                return 0
+            placeholders = ", ".join(["%s"] * len(users))
+            cursor.execute(
+                f"DELETE FROM users WHERE id IN ({placeholders})",
+                [user['id'] for user in users],
+            )
+            self._write_audit_rows(cursor, [
+                {
+                    'user_id': admin_id,
+                    'action_type': 'delete_user',
+                    'action_details': json.dumps({'deleted_user': user['username']}),
+                    'ip_address': ip_address,
+                }
+                for user in users
+            ])
+            conn.commit()
+            self._invalidate_usernames()
+            self._bump_user_version()
+            return len(users)
+        except DatabaseError as e:
+            conn.rollback()
+            print(f"Error deleting users: {e}")
+            raise
         finally:
             cursor.close()
             conn.close()
@@ -294,7 +928,7 @@ class UserDatabase:
             cursor.execute(query, (user_id, session_token, expires_at))
             conn.commit()
             return True
-        except mysql.connector.Error:
+        except DatabaseError:
             return False
         finally:
             cursor.close()
@@ -318,28 +952,118 @@ class UserDatabase:
             cursor.close()
             conn.close()
 
-    def get_audit_logs(self, username: str = None, limit: int = 100) -> List[Dict]:
-        """Get audit logs with optional username filter"""
+    def verify_sessions(self, sessions: List[Tuple[str, str]]) -> List[bool]:
+        """
+        Verify many (user, session_token) pairs with a single query.
+
+        A token is only valid for the user owning it, given by username (what the
+        agents receive in the redirect URL). Results are returned in input order.
+        """
+        tokens = list({token for _, token in sessions if token})
+        if not tokens:
+            return [False] * len(sessions)
+        query = f"""
+        SELECT s.session_token, u.username FROM user_sessions s
+        JOIN users u ON u.id = s.user_id
+        WHERE s.session_token IN ({', '.join(['%s'] * len(tokens))})
+        AND s.expires_at > CURRENT_TIMESTAMP
+        """
+
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, tokens)
+            owners = dict(cursor.fetchall())
+        finally:
+            cursor.close()
+            conn.close()
+        return [user is not None and owners.get(token) == str(user) for user, token in sessions]
+
+    def get_session_user(self, session_token: str) -> Optional[Dict]:
+        """Get the user owning a valid session token"""
+        query = """
+        SELECT u.id, u.username, u.is_admin FROM users u
+        JOIN user_sessions s ON u.id = s.user_id
+        WHERE s.session_token = %s AND s.expires_at > CURRENT_TIMESTAMP
+        """
+
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute(query, (session_token,))
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+            conn.close()
+
+    def _audit_filters(
+        self,
+        username: str = None,
+        action_type: str = None,
+        start: datetime = None,
+        end: datetime = None,
+        text: str = None,
+    ) -> Tuple[List[str], List]:
+        """
+        Build WHERE clauses for audit log queries. User, action and time filters
+        are backed by indexes; the free text match is not (see below).
+        """
+        clauses, params = [], []
         if username and username != "All Users":
-            query = """
-            SELECT a.*, u.username 
-            FROM audit_log a
-            JOIN users u ON a.user_id = u.id
-            WHERE u.username = %s
-            ORDER BY a.timestamp DESC
-            LIMIT %s
-            """
-            params = (username, limit)
-        else:
-            query = """
-            SELECT a.*, u.username 
-            FROM audit_log a
-            JOIN users u ON a.user_id = u.id
-            ORDER BY a.timestamp DESC
-            LIMIT %s
-            """
-            params = (limit,)
-        
+            clauses.append("a.user_id = (SELECT id FROM users WHERE username = %s)")
+            params.append(username)
+        if action_type:
+            clauses.append("a.action_type = %s")
+            params.append(action_type)
+        if start:
+            clauses.append("a.timestamp >= %s")
+            params.append(start)
+        if end:
+            clauses.append("a.timestamp < %s")
+            params.append(end)
+        if text:
+            # Unindexed: FULLTEXT indexes are not available on partitioned tables.
+            # The scan is bounded by the filters above and stops once a page is filled
+            pattern = f"%{text}%"
+            clauses.append(
+                "(a.action_type LIKE %s OR a.ip_address LIKE %s OR u.username LIKE %s"
+                " OR CAST(a.action_details AS CHAR) LIKE %s)"
+            )
+            params.extend([pattern] * 4)
+        return clauses, params
+
+    def search_audit_logs(
+        self,
+        username: str = None,
+        action_type: str = None,
+        start: datetime = None,
+        end: datetime = None,
+        text: str = None,
+        before: Optional[Tuple[datetime, int]] = None,
+        limit: int = 100,
+    ) -> List[Dict]:
+        """
+        Get one page of audit logs, newest first.
+
+        Pages are keyset based: pass the (timestamp, id) of the last row of a page
+        as `before` to get the next one, so deep pages cost the same as the first.
+        Entries of deleted users are kept, with their stored user_id as username.
+        """
+        clauses, params = self._audit_filters(username, action_type, start, end, text)
+        if before:
+            clauses.append("(a.timestamp < %s OR (a.timestamp = %s AND a.id < %s))")
+            params.extend([before[0], before[0], before[1]])
+
+        query = """
+        SELECT a.*, COALESCE(u.username, CAST(a.user_id AS CHAR)) AS username
+        FROM audit_log a
+        LEFT JOIN users u ON a.user_id = u.id
+        """
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY a.timestamp DESC, a.id DESC LIMIT %s"
+        params.append(limit)
+
         conn = self._get_connection()
         try:
             cursor = conn.cursor(dictionary=True)
@@ -348,3 +1072,76 @@ class UserDatabase:
         finally:
             cursor.close()
             conn.close()
+
+    def iter_audit_logs(
+        self,
+        username: str = None,
+        action_type: str = None,
+        start: datetime = None,
+        end: datetime = None,
+        text: str = None,
+        batch_size: int = 1000,
+    ) -> Iterator[Dict]:
+        """
+        Stream every audit log matching the filters, newest first.
+
+        Rows are read through an unbuffered cursor in batches of `batch_size`,
+        so memory stays flat however many rows match. The pooled connection is
+        held until the iterator is exhausted or closed.
+        """
+        clauses, params = self._audit_filters(username, action_type, start, end, text)
+        query = """
+        SELECT a.*, COALESCE(u.username, CAST(a.user_id AS CHAR)) AS username
+        FROM audit_log a
+        LEFT JOIN users u ON a.user_id = u.id
+        """
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY a.timestamp DESC, a.id DESC"
+
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor(dictionary=True, buffered=False)
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            # Drain unread rows so the connection can go back to the pool
+            if conn.unread_result:
+                conn.consume_results()
+            cursor.close()
+            conn.close()
+
+    def get_audit_action_types(self) -> List[str]:
+        """Get the distinct audit action types"""
+        query = "SELECT DISTINCT action_type FROM audit_log ORDER BY action_type"
+
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query)
+            return [row[0] for row in cursor.fetchall() if row[0]]
+        finally:
+            cursor.close()
+            conn.close()
+
+    def get_audit_logs(self, username: str = None, limit: int = 100) -> List[Dict]:
+        """Get audit logs with optional username filter"""
+        return self.search_audit_logs(username=username, limit=limit)
+
+
+def _reset_after_fork():
+    """Forked workers (serving.py) must not share the parent's connections or audit writer thread"""
+    instance = UserDatabase._instance
+    if instance is not None:
+        cls = type(instance)
+        cls._pool = None
+        cls._setup_connection_pool()
+    UserDatabase._audit_writer = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,245 @@
+# load_test.py
+"""
+Load test for the login and session validation hot paths.
+
+Drives UserDatabase.verify_login, create_session, verify_session and the Flask
+/validate_session endpoint from concurrent threads and reports throughput,
+latency percentiles and connection pool saturation.
+
+By default it runs against a throwaway SQLite database (DB_BACKEND=sqlite), so
+it needs no MySQL server. Pass --backend mysql to measure the configured MySQL
+database instead (the seeded loadtest_* users are left in place).
+
+    python load_test.py --users 10000 --sessions 5000 --threads 1,8,32 --duration 10
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import secrets
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+SCENARIOS = ["verify_login", "create_session", "verify_session", "http_validate_session"]
+# Pool metrics that are levels rather than running totals, not differenced between snapshots
+POOL_GAUGES = {"in_use", "idle", "pool_size", "wait_ms_avg", "wait_ms_max"}
+POOL_SAMPLE_INTERVAL = 0.005
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def pool_delta(before: Dict, after: Dict) -> Dict:
+    """Counters of pool metrics `after` minus `before`, what one scenario added"""
+    delta = {}
+    for key, value in after.items():
+        if key in POOL_GAUGES:
+            continue
+        if isinstance(value, dict):
+            delta[key] = {label: count - before[key].get(label, 0) for label, count in value.items()}
+        elif isinstance(value, (int, float)):
+            delta[key] = value - before.get(key, 0)
+        else:
+            delta[key] = value
+    if "wait_ms_total" in delta:
+        delta["wait_ms_avg"] = delta["wait_ms_total"] / delta["checkouts"] if delta["checkouts"] else 0.0
+    if "pool_size" in after:
+        delta["pool_size"] = after["pool_size"]
+    return delta
+
+
+def run_scenario(
+    operation: Callable[[random.Random], bool], threads: int, duration: float, pool_metrics: Callable[[], Dict] = None
+) -> Dict:
+    """
+    Call `operation` from `threads` threads for `duration` seconds.
+
+    With `pool_metrics`, the result carries what the scenario added to the pool
+    counters and the peak number of connections in use, sampled while the
+    workers run.
+    """
+    latencies = [[] for _ in range(threads)]
+    errors = [0] * threads
+    start_barrier = threading.Barrier(threads + 1)
+    deadline = [0.0]
+
+    def worker(index):
+        rng = random.Random(index)
+        start_barrier.wait()
+        while time.perf_counter() < deadline[0]:
+            started = time.perf_counter()
+            try:
+                ok = operation(rng)
+            except Exception:
+                ok = False
+            latencies[index].append(time.perf_counter() - started)
+            if not ok:
+                errors[index] += 1
+
+    running = threading.Event()
+    peak_in_use = [0]
+
+    def monitor():
+        while running.is_set():
+            peak_in_use[0] = max(peak_in_use[0], pool_metrics().get("in_use", 0))
+            time.sleep(POOL_SAMPLE_INTERVAL)
+
+    workers = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    sampler = threading.Thread(target=monitor, daemon=True) if pool_metrics else None
+    if sampler:
+        pool_before = pool_metrics()
+        running.set()
+        sampler.start()
+    deadline[0] = time.perf_counter() + duration
+    started = time.perf_counter()
+    start_barrier.wait()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    running.clear()
+
+    merged = sorted(value for values in latencies for value in values)
+    result = {
+        "threads": threads,
+        "requests": len(merged),
+        "errors": sum(errors),
+        "throughput": len(merged) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(merged, 50) * 1000,
+        "p90_ms": percentile(merged, 90) * 1000,
+        "p99_ms": percentile(merged, 99) * 1000,
+        "max_ms": (merged[-1] if merged else 0.0) * 1000,
+    }
+    if sampler:
+        sampler.join()
+        result["pool"] = pool_delta(pool_before, pool_metrics())
+        if "pool_size" in result["pool"]:
+            result["pool"]["in_use_peak"] = peak_in_use[0]
+    return result
+
+
+def seed(db, users: int, sessions: int) -> List[Dict]:
+    """Create `users` accounts and `sessions` live sessions, return the session list"""
+    password = hashlib.sha256(b"loadtest").hexdigest()
+    existing = set(db.get_usernames())
+    batch = []
+    for i in range(users):
+        username = f"loadtest_{i}"
+        if username in existing:
+            continue
+        batch.append({
+            "username": username,
+            "password": password,
+            "email": f"{username}@loadtest.local",
+            "is_approved": True,
+        })
+        if len(batch) == 1000:
+            db.bulk_create_users(batch, None, "load_test")
+            batch = []
+    db.bulk_create_users(batch, None, "load_test")
+
+    expires_at = datetime.now() + timedelta(hours=1)
+    seeded = []
+    for i in range(sessions):
+        user = db.get_user_by_username(f"loadtest_{i % users}")
+        token = secrets.token_urlsafe(32)
+        db.create_session(user["id"], token, expires_at)
+        seeded.append({"user_id": user["id"], "username": user["username"], "session_token": token})
+    return seeded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test login and session validation")
+    parser.add_argument("--backend", choices=["sqlite", "mysql"], default="sqlite")
+    parser.add_argument("--sqlite-path", help="SQLite file to use, a temporary one by default")
+    parser.add_argument("--users", type=int, default=1000, help="user accounts to seed")
+    parser.add_argument("--sessions", type=int, default=1000, help="live sessions to seed")
+    parser.add_argument("--threads", default="1,4,16", help="comma separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per scenario and level")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    # Select the backend before database is imported by anything
+    if args.backend == "sqlite":
+        os.environ["DB_BACKEND"] = "sqlite"
+        os.environ["SQLITE_PATH"] = args.sqlite_path or os.path.join(
+            tempfile.mkdtemp(prefix="qvp-loadtest-"), "user_auth.db"
+        )
+    os.environ.setdefault("AUDIT_SPILL_FILE", os.path.join(tempfile.gettempdir(), "loadtest_audit_spill.jsonl"))
+
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    from database import UserDatabase
+
+    db = UserDatabase()
+    db.initialize_database()
+    print(f"Seeding {args.users} users and {args.sessions} sessions ...", file=sys.stderr)
+    sessions = seed(db, args.users, args.sessions)
+    expires_at = datetime.now() + timedelta(hours=1)
+    local = threading.local()
+
+    def client():
+        if not hasattr(local, "client"):
+            import session_query_handler
+
+            local.client = session_query_handler.app.test_client()
+        return local.client
+
+    def validate_over_http(session):
+        response = client().post(
+            "/validate_session",
+            json={"user_id": session["username"], "session_token": session["session_token"]},
+        )
+        return response.status_code == 200 and response.get_json()["valid"]
+
+    operations = {
+        "verify_login": lambda rng: db.verify_login(f"loadtest_{rng.randrange(args.users)}", "loadtest") is not None,
+        "create_session": lambda rng: db.create_session(
+            rng.choice(sessions)["user_id"], secrets.token_urlsafe(32), expires_at
+        ),
+        "verify_session": lambda rng: db.verify_session(rng.choice(sessions)["session_token"]),
+        "http_validate_session": lambda rng: validate_over_http(rng.choice(sessions)),
+    }
+
+    results = []
+    for name in args.scenarios.split(","):
+        for threads in [int(value) for value in args.threads.split(",")]:
+            result = run_scenario(operations[name], threads, args.duration, db.get_pool_metrics)
+            result["scenario"] = name
+            results.append(result)
+            if not args.json:
+                pool = result["pool"]
+                if "pool_size" in pool:
+                    saturation = (
+                        f" pool in_use_peak={pool['in_use_peak']}/{pool['pool_size']}"
+                        f" wait_avg={pool['wait_ms_avg']:.2f}ms timeouts={pool['timeouts']}"
+                    )
+                else:
+                    # SQLite: one connection per thread, no pool to saturate
+                    saturation = f" checkouts={pool['checkouts']} opened={pool['opened']}"
+                print(
+                    f"{name:24} threads={threads:<4} req={result['requests']:<8} "
+                    f"err={result['errors']:<5} {result['throughput']:>9.1f} req/s  "
+                    f"p50={result['p50_ms']:.2f}ms p90={result['p90_ms']:.2f}ms "
+                    f"p99={result['p99_ms']:.2f}ms max={result['max_ms']:.2f}ms{saturation}"
+                )
+
+    if args.json:
+        print(json.dumps(results, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+# serving.py
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable
+
+from flask import Flask, g, request
+from loguru import logger
+from werkzeug.serving import BaseWSGIServer
+
+# Upper bounds (ms) of the request latency histogram buckets
+LATENCY_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+# Worker processes and threads per worker, also the SESSION_WORKERS / SESSION_THREADS defaults in .env
+DEFAULT_WORKERS = 2
+DEFAULT_THREADS = 16
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into one.
+
+    While a call for a key is running, other callers with that key wait for it
+    and get its result (or exception) instead of doing the work again.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, "SingleFlight._Call"] = {}
+        self._stats = {"calls": 0, "shared": 0}
+
+    def do(self, key: Hashable, fn: Callable):
+        with self._lock:
+            self._stats["calls"] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+            else:
+                self._stats["shared"] += 1
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            return dict(self._stats)
+
+
+class LatencyStats:
+    """Per-endpoint request counters and latency histograms of a Flask app"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints: Dict[str, Dict] = {}
+
+    def instrument(self, app: Flask):
+        @app.before_request
+        def start_timer():
+            g.request_started = time.perf_counter()
+
+        @app.after_request
+        def record_latency(response):
+            started = g.pop("request_started", None)
+            if started is not None:
+                self.record(request.endpoint or "unknown", time.perf_counter() - started, response.status_code)
+            return response
+
+    def record(self, endpoint: str, seconds: float, status: int):
+        elapsed_ms = seconds * 1000
+        bucket = next(
+            (i for i, bound in enumerate(LATENCY_BUCKETS_MS) if elapsed_ms <= bound),
+            len(LATENCY_BUCKETS_MS),
+        )
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {
+                "requests": 0,
+                "errors": 0,
+                "latency_ms_total": 0.0,
+                "latency_ms_max": 0.0,
+                "histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+            })
+            stats["requests"] += 1
+            stats["errors"] += status >= 500
+            stats["latency_ms_total"] += elapsed_ms
+            stats["latency_ms_max"] = max(stats["latency_ms_max"], elapsed_ms)
+            stats["histogram"][bucket] += 1
+
+    def metrics(self) -> Dict:
+        """Snapshot of the counters of this worker process"""
+        labels = [f"le_{bound}ms" for bound in LATENCY_BUCKETS_MS] + ["inf"]
+        with self._lock:
+            snapshot = {}
+            for endpoint, stats in self._endpoints.items():
+                snapshot[endpoint] = {
+                    **{key: value for key, value in stats.items() if key != "histogram"},
+                    "latency_ms_avg": stats["latency_ms_total"] / stats["requests"],
+                    "histogram": dict(zip(labels, stats["histogram"])),
+                }
+        return snapshot
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """Werkzeug server handling requests on a fixed size thread pool"""
+
+    multithread = True
+
+    def __init__(self, host: str, port: int, app, threads: int, fd: int = None):
+        super().__init__(host, port, app, fd=fd)
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="http")
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        self._executor.shutdown(wait=True)
+        super().server_close()
+
+
+def _run_worker(app: Flask, host: str, port: int, threads: int, fd: int):
+    server = PooledWSGIServer(host, port, app, threads, fd=fd)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever to return, so it can't run on the serving thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info(f"Worker {os.getpid()} serving with {threads} threads")
+    server.serve_forever()
+    server.server_close()
+
+
+def serve(app: Flask, host: str, port: int, workers: int = DEFAULT_WORKERS, threads: int = DEFAULT_THREADS, dev: bool = False):
+    """
+    Serve `app` with `workers` pre-forked processes of `threads` threads each.
+
+    The listening socket is opened once and shared by the workers, the parent
+    only restarts workers that die and forwards SIGTERM/SIGINT to them.
+    `dev=True` (or a platform without fork) falls back to Flask's development
+    server.
+    """
+    if dev or not hasattr(os, "fork"):
+        app.run(host=host, port=port, threaded=True)
+        return
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.set_inheritable(True)
+    logger.info(f"Listening on {host}:{port} with {workers} workers x {threads} threads")
+
+    if workers <= 1:
+        _run_worker(app, host, port, threads, sock.fileno())
+        return
+
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                _run_worker(app, host, port, threads, sock.fileno())
+            finally:
+                # Leave through the normal exit path so atexit handlers (audit writer) run
+                sys.exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            logger.warning(f"Worker {pid} exited with status {status}, restarting")
+            time.sleep(1)
+            spawn()
+    sock.close()
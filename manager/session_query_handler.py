@@ -1,6 +1,10 @@
 #session_query_handler.py
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from database import UserDatabase
+from audit_export import EXPORT_FORMATS, read_export_token, stream_audit_export
+from agent_registry import AgentRegistry
+from serving import DEFAULT_THREADS, DEFAULT_WORKERS, LatencyStats, SingleFlight, serve
+from datetime import datetime
 import os
 from dotenv import load_dotenv
 from loguru import logger
@@ -13,7 +17,17 @@ load_dotenv(".env", override=True)
 
 app = Flask(__name__)
 db = UserDatabase()  # Initialize your database connection
+latency = LatencyStats()
+latency.instrument(app)
+# Simultaneous validations of the same token (login storms) share one database lookup
+session_lookups = SingleFlight()
 AGENTS_FILE = "agents.txt"
+SESSION_BATCH_LIMIT = 500
+registry = AgentRegistry(
+    os.getenv("AGENT_JOURNAL", "agents.journal"),
+    lease_ttl=float(os.getenv("AGENT_LEASE_TTL", 90)),
+)
+registry.import_legacy(AGENTS_FILE)
 
 def is_valid_ip(ip):
     try:
@@ -23,16 +37,9 @@ def is_valid_ip(ip):
         return False
     
 def read_agents():
-    if not os.path.exists(AGENTS_FILE):
-        return []
-    with open(AGENTS_FILE, 'r') as file:
-        agents = file.read().splitlines()
-        return agents
-    
-def write_agents(agents):
-    with open(AGENTS_FILE, 'w') as file:
-        for agent in agents:
-            file.write(f"{agent}\n")
+    """Agents whose lease is still live"""
+    return registry.live_agents()
+
 @app.route("/validate_session", methods=["POST"])
 def validate_session():
     """
@@ -40,7 +47,7 @@ def validate_session():
     """
     # Get the payload from the request
     data = request.get_json()
-    logger.info(f"Got request from : {json.dumps(data, indent=4)}")
+    logger.debug(f"Got request from : {json.dumps(data, indent=4)}")
 
     user_id = data.get("user_id")
     session_token = data.get("session_token")
@@ -48,8 +55,11 @@ def validate_session():
     if not user_id or not session_token:
         return jsonify({"valid": False, "message": "user_id and session_token are required"}), 400
 
-    # Check if the session is valid
-    is_valid = db.verify_session(session_token)
+    # Check that the session is valid and belongs to user_id, the username
+    is_valid = session_lookups.do(
+        (str(user_id), session_token),
+        lambda: db.verify_sessions([(user_id, session_token)])[0],
+    )
 
     if is_valid:
         logger.success(f"Valid session found")
@@ -58,6 +68,78 @@ def validate_session():
         logger.error(f"No valid session found !!")
         return jsonify({"valid": False, "message": "Session is invalid."}), 200
 
+@app.route("/validate_sessions", methods=["POST"])
+def validate_sessions():
+    """
+    Validate many sessions at once.
+    Expects {"sessions": [{"user_id": ..., "session_token": ...}, ...]}, answers
+    with one {"user_id", "valid"} result per session in the same order.
+    """
+    data = request.get_json(silent=True) or {}
+    sessions = data.get("sessions")
+    if not isinstance(sessions, list) or not all(isinstance(item, dict) for item in sessions):
+        return jsonify({"valid": False, "message": "sessions must be a list of {user_id, session_token}"}), 400
+    if len(sessions) > SESSION_BATCH_LIMIT:
+        return jsonify({"valid": False, "message": f"At most {SESSION_BATCH_LIMIT} sessions per request"}), 400
+
+    pairs = [(item.get("user_id"), item.get("session_token")) for item in sessions]
+    results = db.verify_sessions(pairs)
+    return jsonify({
+        "results": [{"user_id": user_id, "valid": valid} for (user_id, _), valid in zip(pairs, results)]
+    }), 200
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Expose database connection pool and request latency metrics of this worker.
+    """
+    return jsonify({
+        "worker": os.getpid(),
+        "db_pool": db.get_pool_metrics(),
+        "endpoints": latency.metrics(),
+        "session_lookups": session_lookups.metrics(),
+    }), 200
+
+@app.route("/export_audit_logs", methods=["GET"])
+def export_audit_logs():
+    """
+    Stream audit logs matching the viewer filters as CSV or NDJSON, optionally gzipped.
+    Takes an export token issued by the admin app, which fixes the filters and expires
+    after a few minutes; the admin's session token never appears in the URL.
+    """
+    token = read_export_token(request.args.get("token", ""))
+    if token is None:
+        return jsonify({"valid": False, "message": "valid export token required"}), 403
+    user = db.get_user_by_username(token["username"])
+    if not user or not user["is_admin"] or user["id"] != token["user_id"]:
+        return jsonify({"valid": False, "message": "admin required"}), 403
+    args = token["params"]
+
+    fmt = args.get("format", "csv")
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"valid": False, "message": f"format must be one of {list(EXPORT_FORMATS)}"}), 400
+
+    try:
+        start = datetime.fromisoformat(args["start"]) if args.get("start") else None
+        end = datetime.fromisoformat(args["end"]) if args.get("end") else None
+    except ValueError:
+        return jsonify({"valid": False, "message": "start and end must be ISO timestamps"}), 400
+
+    rows = db.iter_audit_logs(
+        username=args.get("username"),
+        action_type=args.get("action_type"),
+        start=start,
+        end=end,
+        text=args.get("text"),
+    )
+    chunks, mimetype, file_name = stream_audit_export(rows, fmt, args.get("gzip") == "1")
+    logger.info(f"Audit log export ({fmt}) started by {user['username']}")
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={file_name}"},
+    )
+
 @app.route("/register_agent", methods=["POST"])
 def register_agent():
     data = request.get_json()
@@ -68,14 +150,12 @@ def register_agent():
     if not is_valid_ip(agent):
         return jsonify({"valid": False, "message": "agent id must be valid IP address"}), 400
     
-    agents = read_agents()
-    if agent in agents:
-        return jsonify({"valid": False, "message": "Agent already registered"}), 400
+    # Registering again renews the lease, agents call this periodically as a heartbeat
+    if not registry.register(agent):
+        return jsonify({"valid": True, "message": "Agent lease renewed", "lease_ttl": registry.lease_ttl}), 200
 
-    agents.append(agent)
-    write_agents(agents)
     logger.success(f"Agent {agent} registerd successfully")
-    return jsonify({"valid": True, "message": "Agent registerd successfully"}), 200
+    return jsonify({"valid": True, "message": "Agent registerd successfully", "lease_ttl": registry.lease_ttl}), 200
 
 @app.route("/unregister_agent", methods=["POST"])
 def unregister_agent():
@@ -87,22 +167,29 @@ def unregister_agent():
     if not is_valid_ip(agent):
         return jsonify({"valid": False, "message": "agent id must be valid IP address"}), 400
     
-    agents = read_agents()
-    if agent not in agents:
+    if not registry.unregister(agent):
         return jsonify({"valid": False, "message": "Agent not found"}), 400
 
-    agents.remove(agent)
-    write_agents(agents)
     logger.success(f"Agent {agent} unregisterd successfully")
     return jsonify({"valid": True, "message": "Agent unregisterd successfully"}), 200
 
 
-if __name__ == "__main__":
+def session_port():
+    """Port of this server, `server.session_port` of .streamlit/config.toml"""
     config_path = os.path.join('.streamlit', 'config.toml')
     if os.path.exists(config_path):
         config = toml.load(config_path)
-        port = config.get('server', {}).get('session_port', 8501)
-    else:
-        port = 8501
-    app.run(host="0.0.0.0", port=port)
+        return config.get('server', {}).get('session_port', 8501)
+    return 8501
+
+
+if __name__ == "__main__":
+    serve(
+        app,
+        "0.0.0.0",
+        session_port(),
+        workers=int(os.getenv("SESSION_WORKERS", DEFAULT_WORKERS)),
+        threads=int(os.getenv("SESSION_THREADS", DEFAULT_THREADS)),
+        dev=os.getenv("SESSION_SERVER_MODE", "production") == "dev",
+    )
 
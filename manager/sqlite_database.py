@@ -0,0 +1,262 @@
+# sqlite_database.py
+import json
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict
+
+from audit_archive import archive_path, write_archive
+from database import DatabaseConfig, UserDatabase
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s|%s|%%")
+
+
+@lru_cache(maxsize=512)
+def _translate(query: str) -> str:
+    """Rewrite MySQL flavoured SQL (pyformat placeholders, CURRENT_TIMESTAMP) for SQLite"""
+    def placeholder(match):
+        if match.group(1):
+            return f":{match.group(1)}"
+        return "?" if match.group(0) == "%s" else "%"
+
+    query = _PLACEHOLDER.sub(placeholder, query)
+    # MySQL TIMESTAMPs are in the session (local) time zone, SQLite's CURRENT_TIMESTAMP is UTC
+    return query.replace("CURRENT_TIMESTAMP", "(datetime('now', 'localtime'))")
+
+
+def _dict_row(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class SQLiteCursor:
+    """Cursor with the subset of the mysql.connector cursor API used by UserDatabase"""
+
+    def __init__(self, cursor: sqlite3.Cursor, dictionary: bool):
+        self._cursor = cursor
+        if dictionary:
+            self._cursor.row_factory = _dict_row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, query, params=()):
+        return self._cursor.execute(_translate(query), params or ())
+
+    def executemany(self, query, seq_of_params):
+        return self._cursor.executemany(_translate(query), seq_of_params)
+
+
+class SQLiteConnection:
+    """Per-thread SQLite connection that looks like a pooled mysql.connector connection"""
+
+    unread_result = False
+
+    def __init__(self, path: str):
+        self._cnx = sqlite3.connect(
+            path,
+            timeout=10,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            cached_statements=256,
+        )
+        self._cnx.execute("PRAGMA journal_mode = WAL")
+        self._cnx.execute("PRAGMA synchronous = NORMAL")
+        self._cnx.execute("PRAGMA foreign_keys = ON")
+
+    def cursor(self, dictionary: bool = False, buffered: bool = None) -> SQLiteCursor:
+        return SQLiteCursor(self._cnx.cursor(), dictionary)
+
+    @property
+    def in_transaction(self) -> bool:
+        return self._cnx.in_transaction
+
+    def commit(self):
+        self._cnx.commit()
+
+    def rollback(self):
+        self._cnx.rollback()
+
+    def consume_results(self):
+        pass
+
+    def close(self):
+        # The connection stays open for the next checkout on this thread
+        if self._cnx.in_transaction:
+            self._cnx.rollback()
+
+
+class SQLiteConnectionProvider:
+    """Hands out one SQLite connection per thread, in place of a MySQL pool"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {"checkouts": 0, "opened": 0}
+
+    def get_connection(self) -> SQLiteConnection:
+        cnx = getattr(self._local, "cnx", None)
+        if cnx is None:
+            cnx = self._local.cnx = SQLiteConnection(self.path)
+            with self._lock:
+                self._stats["opened"] += 1
+        with self._lock:
+            self._stats["checkouts"] += 1
+        return cnx
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            return {"backend": "sqlite", "path": self.path, **self._stats}
+
+
+class SQLiteUserDatabase(UserDatabase):
+    """
+    UserDatabase stored in an embedded SQLite file, selected with DB_BACKEND=sqlite.
+
+    Meant for single-node installs and local testing: no MySQL server is needed.
+    All queries are shared with the MySQL backend; only schema management and
+    audit retention differ, since SQLite has no partitioning.
+    """
+
+    @classmethod
+    def _setup_connection_pool(cls):
+        if cls._pool is None:
+            db_config = DatabaseConfig()
+            print({'backend': 'sqlite', 'path': db_config.sqlite_path})
+            cls._pool = SQLiteConnectionProvider(db_config.sqlite_path)
+
+    def initialize_database(self):
+        """Create necessary tables if they don't exist"""
+        create_tables_query = """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username VARCHAR(50) UNIQUE NOT NULL,
+            password VARCHAR(256) NOT NULL,
+            email VARCHAR(100) UNIQUE NOT NULL,
+            is_admin BOOLEAN DEFAULT FALSE,
+            is_approved BOOLEAN DEFAULT FALSE,
+            redirect_url TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_login TIMESTAMP,
+            status VARCHAR(20) DEFAULT 'active',
+            metadata JSON
+        );
+
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            session_token VARCHAR(256),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_sessions_token ON user_sessions (session_token);
+
+        CREATE TABLE IF NOT EXISTS audit_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            action_type VARCHAR(50),
+            action_details JSON,
+            ip_address VARCHAR(50),
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_audit_timestamp ON audit_log (timestamp);
+        CREATE INDEX IF NOT EXISTS idx_audit_user_ts ON audit_log (user_id, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_audit_action_ts ON audit_log (action_type, timestamp);
+
+        CREATE TABLE IF NOT EXISTS audit_rollup_hourly (
+            bucket TIMESTAMP NOT NULL,
+            action_type VARCHAR(50) NOT NULL,
+            user_id INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, action_type, user_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS audit_rollup_daily (
+            bucket TIMESTAMP NOT NULL,
+            action_type VARCHAR(50) NOT NULL,
+            user_id INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, action_type, user_id)
+        );
+        """
+        if UserDatabase._initialized:
+            return
+
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            for query in create_tables_query.split(';'):
+                if query.strip():
+                    cursor.execute(query)
+            conn.commit()
+
+            # Create default admin if not exists
+            self.create_default_admin()
+            UserDatabase._initialized = True
+        except Exception as e:
+            print(f"Database initialization error: {e}")
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+    def _rollup_upsert_query(self, table: str) -> str:
+        return f"""
+        INSERT INTO {table} (bucket, action_type, user_id, count)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (bucket, action_type, user_id) DO UPDATE SET count = count + excluded.count
+        """
+
+    def maintain_audit_log(self, retention_days: int = None, archive_dir: str = None) -> Dict:
+        """
+        Archive audit entries older than the retention window and delete them.
+        SQLite has no partitions, so this is a plain DELETE, fine at single-node scale.
+        """
+        retention = DatabaseConfig().audit_retention
+        retention_days = retention_days if retention_days is not None else retention['retention_days']
+        archive_dir = archive_dir or retention['archive_dir']
+        os.makedirs(archive_dir, exist_ok=True)
+        cutoff = (datetime.now() - timedelta(days=retention_days)).replace(microsecond=0)
+
+        if not self.flush_audit_log(timeout=60):
+            print("Audit writer did not flush within 60s, maintaining without the queued entries")
+        name = f"before{cutoff:%Y%m%d%H%M%S}"
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute("""
+            SELECT a.id, a.user_id, u.username, a.action_type, a.action_details,
+                   a.ip_address, a.timestamp
+            FROM audit_log a
+            LEFT JOIN users u ON a.user_id = u.id
+            WHERE a.timestamp < %s
+            ORDER BY a.timestamp, a.id
+            """, (cutoff,))
+
+            def rows():
+                for row in cursor:
+                    row['action_details'] = json.loads(row['action_details'] or 'null')
+                    row['timestamp'] = row['timestamp'].isoformat()
+                    yield row
+
+            count = write_archive(archive_path(archive_dir, name), rows())
+            if count:
+                cursor.execute("DELETE FROM audit_log WHERE timestamp < %s", (cutoff,))
+                conn.commit()
+            else:
+                os.remove(archive_path(archive_dir, name))
+        finally:
+            cursor.close()
+            conn.close()
+        return {'added': [], 'archived': {name: count} if count else {}}